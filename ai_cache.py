@@ -0,0 +1,105 @@
+import difflib
+import hashlib
+import logging
+import re
+import time
+
+import avito_api
+import database as db
+
+logger = logging.getLogger(__name__)
+
+PRUNE_EVERY = 50
+FUZZY_CANDIDATES = 200
+
+
+def normalize_text(text):
+    # «Актуально?», «актуально!!» и «  Актуально » дают один ключ.
+    text = (text or '').lower().replace('ё', 'е')
+    return ' '.join(re.sub(r'[^\w\s]', ' ', text).split())
+
+
+def _hash(*parts):
+    return hashlib.sha256('\x1f'.join(parts).encode()).hexdigest()
+
+
+class AIReplyCache:
+    def __init__(self, ttl=7 * 24 * 3600, max_entries=5000, fuzzy_threshold=0.0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.fuzzy_threshold = fuzzy_threshold
+        self.stats = {'exact_hits': 0, 'fuzzy_hits': 0, 'misses': 0, 'stored': 0}
+        self._puts_since_prune = 0
+
+    def _keys(self, account_id, item_id, provider, prompt_text, messages):
+        if not item_id:
+            return None
+        # Ключ строится по тому же окну истории, которое видит модель.
+        window = [(msg.get('direction', ''), normalize_text((msg.get('content') or {}).get('text')))
+                  for msg in sorted(messages, key=lambda x: x.get('created', 0))[-avito_api.CHAT_HISTORY_LIMIT:]]
+        if not window or window[-1][0] != 'in' or not window[-1][1]:
+            return None
+        # Область — аккаунт, объявление, провайдер, промпт и предшествующий контекст;
+        # внутри нее сравниваем последнее сообщение.
+        scope_key = _hash(str(account_id), str(item_id), provider, normalize_text(prompt_text),
+                          *(f"{d}:{t}" for d, t in window[:-1]))
+        last_message = window[-1][1]
+        return _hash(scope_key, last_message), scope_key, last_message
+
+    def _min_created_at(self):
+        return int(time.time()) - self.ttl
+
+    def get(self, account_id, item_id, provider, prompt_text, messages):
+        keys = self._keys(account_id, item_id, provider, prompt_text, messages)
+        if keys is None:
+            return None
+        cache_key, scope_key, last_message = keys
+
+        entry = db.get_ai_cache_entry(cache_key, self._min_created_at())
+        if entry:
+            db.touch_ai_cache_entry(cache_key)
+            self.stats['exact_hits'] += 1
+            return entry['reply_text']
+
+        if self.fuzzy_threshold > 0:
+            match = self._find_fuzzy(scope_key, last_message)
+            if match:
+                db.touch_ai_cache_entry(match['cache_key'])
+                self.stats['fuzzy_hits'] += 1
+                return match['reply_text']
+
+        self.stats['misses'] += 1
+        return None
+
+    def _find_fuzzy(self, scope_key, last_message):
+        best, best_ratio = None, self.fuzzy_threshold
+        for candidate in db.get_ai_cache_candidates(scope_key, self._min_created_at(), FUZZY_CANDIDATES):
+            matcher = difflib.SequenceMatcher(None, last_message, candidate['last_message'])
+            if matcher.quick_ratio() < best_ratio:
+                continue
+            ratio = matcher.ratio()
+            if ratio >= best_ratio:
+                best, best_ratio = candidate, ratio
+        return best
+
+    def put(self, account_id, item_id, provider, prompt_text, messages, reply_text):
+        keys = self._keys(account_id, item_id, provider, prompt_text, messages)
+        if keys is None or not reply_text or not reply_text.strip():
+            return
+        db.put_ai_cache_entry(*keys, reply_text)
+        self.stats['stored'] += 1
+
+        self._puts_since_prune += 1
+        if self._puts_since_prune >= PRUNE_EVERY:
+            self._puts_since_prune = 0
+            removed = db.prune_ai_cache(self.max_entries, self._min_created_at())
+            if removed:
+                logger.info(f"Кэш AI-ответов: удалено записей {removed}.")
+
+    def get_stats(self):
+        lookups = self.stats['exact_hits'] + self.stats['fuzzy_hits'] + self.stats['misses']
+        hits = self.stats['exact_hits'] + self.stats['fuzzy_hits']
+        return {**self.stats, 'hit_rate': round(hits / lookups, 3) if lookups else 0.0}
+
+
+reply_cache = AIReplyCache()
@@ -0,0 +1,360 @@
+import asyncio
+import contextlib
+import hashlib
+import logging
+import time
+
+import httpx
+import openai
+import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+
+import avito_api
+
+logger = logging.getLogger(__name__)
+
+PROVIDERS = {
+    'openai': {'kind': 'openai', 'model': 'gpt-4o'},
+    'deepseek': {'kind': 'openai', 'model': 'deepseek-chat', 'base_url': 'https://api.deepseek.com'},
+    'gemini': {'kind': 'gemini', 'model': 'gemini-1.5-flash'},
+}
+
+_request_timeout = 60.0
+_connect_timeout = 10.0
+_max_connections = 50
+_max_retries = 2
+
+# Ответ на 429 и временные сбои повторяем сами, освобождая слот на время паузы; встроенные повторы SDK отключены.
+RATE_LIMIT_ERRORS = (openai.RateLimitError, google_exceptions.ResourceExhausted)
+TRANSIENT_ERRORS = (openai.APIConnectionError, openai.InternalServerError,
+                    google_exceptions.ServiceUnavailable, google_exceptions.DeadlineExceeded)
+# Грубая оценка расхода токенов на запрос: ~3 символа промпта на токен плюс типичная длина ответа.
+PROMPT_CHARS_PER_TOKEN = 3
+REPLY_TOKENS_ESTIMATE = 400
+
+# Границы корзин гистограммы задержек, сек.
+LATENCY_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60)
+_latency_stats = {}
+
+_http_client = None
+_http_client_loop = None
+_clients = {}
+_gemini_key = None
+
+
+def configure(request_timeout=None, max_connections=None, max_retries=None):
+    global _request_timeout, _max_connections, _max_retries
+    if request_timeout is not None:
+        _request_timeout = max(1.0, float(request_timeout))
+    if max_connections is not None:
+        _max_connections = max(1, int(max_connections))
+    if max_retries is not None:
+        _max_retries = max(0, int(max_retries))
+
+
+def build_prompt(history, prompt_text):
+    return (f"{prompt_text}\n\nНиже представлена история переписки с клиентом на Avito. Последнее сообщение от клиента. "
+            f"Сгенерируй короткий, вежливый и релевантный ответ от лица продавца.\n\nИстория:\n{history}")
+
+
+def _key_fingerprint(api_key):
+    # Сам ключ в реестре не держим: для сравнения достаточно отпечатка.
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+def _get_http_client():
+    # Один пул соединений на цикл событий для всех OpenAI-совместимых провайдеров.
+    global _http_client, _http_client_loop
+    loop = asyncio.get_running_loop()
+    if _http_client is None or _http_client.is_closed or _http_client_loop is not loop:
+        _http_client = openai.DefaultAsyncHttpxClient(
+            timeout=httpx.Timeout(_request_timeout, connect=_connect_timeout),
+            limits=httpx.Limits(max_connections=_max_connections, max_keepalive_connections=_max_connections),
+        )
+        _http_client_loop = loop
+        _clients.clear()
+    return _http_client
+
+
+def get_client(provider, api_key):
+    global _gemini_key
+    settings = PROVIDERS[provider]
+    fingerprint = _key_fingerprint(api_key)
+
+    if settings['kind'] == 'gemini':
+        # genai хранит ключ глобально, поэтому перенастраиваем его только при смене ключа.
+        if _gemini_key != fingerprint:
+            genai.configure(api_key=api_key)
+            _gemini_key = fingerprint
+            _clients.pop(provider, None)
+        cached = _clients.get(provider)
+        if cached is None:
+            cached = (fingerprint, genai.GenerativeModel(settings['model']))
+            _clients[provider] = cached
+        return cached[1]
+
+    http_client = _get_http_client()
+    cached = _clients.get(provider)
+    if cached is None or cached[0] != fingerprint:
+        if cached is not None:
+            logger.info(f"Ключ API для {provider} изменился, клиент пересоздан.")
+        client = openai.AsyncOpenAI(api_key=api_key, base_url=settings.get('base_url'), http_client=http_client,
+                                    timeout=httpx.Timeout(_request_timeout, connect=_connect_timeout),
+                                    max_retries=0)
+        cached = (fingerprint, client)
+        _clients[provider] = cached
+    return cached[1]
+
+
+class AIRequestLimiter:
+    def __init__(self, provider_concurrency=8, key_concurrency=4, tokens_per_minute=0):
+        self._provider_semaphores = {}
+        self._key_semaphores = {}
+        self._token_buckets = {}
+        self._stats = {}
+        self.configure(provider_concurrency, key_concurrency, tokens_per_minute)
+
+    def configure(self, provider_concurrency=None, key_concurrency=None, tokens_per_minute=None):
+        if provider_concurrency is not None:
+            self.provider_concurrency = max(1, int(provider_concurrency))
+        if key_concurrency is not None:
+            self.key_concurrency = max(1, int(key_concurrency))
+        if tokens_per_minute is not None:
+            self.tokens_per_minute = max(0, int(tokens_per_minute))
+        self._provider_semaphores.clear()
+        self._key_semaphores.clear()
+        self._token_buckets.clear()
+
+    def _provider_stats(self, provider):
+        return self._stats.setdefault(provider, {'queued': 0, 'active': 0, 'max_queue_depth': 0, 'completed': 0,
+                                                 'throttled': 0, 'wait_time_total': 0.0})
+
+    def _token_bucket(self, provider):
+        if not self.tokens_per_minute:
+            return None
+        bucket = self._token_buckets.get(provider)
+        if bucket is None:
+            bucket = avito_api.TokenBucket(self.tokens_per_minute / 60, capacity=self.tokens_per_minute)
+            self._token_buckets[provider] = bucket
+        return bucket
+
+    @contextlib.asynccontextmanager
+    async def slot(self, provider, api_key, estimated_tokens):
+        stats = self._provider_stats(provider)
+        provider_semaphore = self._provider_semaphores.setdefault(
+            provider, asyncio.Semaphore(self.provider_concurrency))
+        key_semaphore = self._key_semaphores.setdefault(
+            _key_fingerprint(api_key), asyncio.Semaphore(self.key_concurrency))
+
+        started_at = time.monotonic()
+        stats['queued'] += 1
+        stats['max_queue_depth'] = max(stats['max_queue_depth'], stats['queued'])
+        queued = True
+        try:
+            async with provider_semaphore, key_semaphore:
+                bucket = self._token_bucket(provider)
+                wait = bucket.reserve(estimated_tokens) if bucket else 0.0
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                stats['queued'] -= 1
+                queued = False
+                stats['active'] += 1
+                stats['wait_time_total'] += time.monotonic() - started_at
+                try:
+                    yield
+                finally:
+                    stats['active'] -= 1
+                    stats['completed'] += 1
+        finally:
+            if queued:
+                stats['queued'] -= 1
+
+    def on_throttled(self, provider, retry_after=None):
+        self._provider_stats(provider)['throttled'] += 1
+        bucket = self._token_bucket(provider)
+        if bucket:
+            bucket.on_throttled(retry_after)
+
+    def on_success(self, provider):
+        bucket = self._token_bucket(provider)
+        if bucket:
+            bucket.on_success()
+
+    def get_stats(self):
+        stats = {}
+        for provider, provider_stats in self._stats.items():
+            completed = provider_stats['completed'] or 1
+            stats[provider] = {
+                'queued': provider_stats['queued'],
+                'active': provider_stats['active'],
+                'max_queue_depth': provider_stats['max_queue_depth'],
+                'throttled': provider_stats['throttled'],
+                'avg_wait_s': round(provider_stats['wait_time_total'] / completed, 2),
+            }
+        return stats
+
+
+limiter = AIRequestLimiter()
+
+
+def _estimate_tokens(prompt):
+    return len(prompt) // PROMPT_CHARS_PER_TOKEN + REPLY_TOKENS_ESTIMATE
+
+
+def _retry_after(error):
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None)
+    return avito_api.parse_retry_after(headers.get('retry-after')) if headers else None
+
+
+def _record_latency(provider, elapsed, ok):
+    stats = _latency_stats.setdefault(provider, {
+        'ok': 0, 'failed': 0, 'total_time': 0.0, 'buckets': [0] * (len(LATENCY_BUCKETS) + 1)})
+    stats['ok' if ok else 'failed'] += 1
+    stats['total_time'] += elapsed
+    bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS) if elapsed <= bound), len(LATENCY_BUCKETS))
+    stats['buckets'][bucket] += 1
+
+
+def get_stats():
+    result = {'queue': limiter.get_stats()}
+    for provider, stats in _latency_stats.items():
+        calls = stats['ok'] + stats['failed']
+        labels = [f"<={bound}s" for bound in LATENCY_BUCKETS] + [f">{LATENCY_BUCKETS[-1]}s"]
+        result[provider] = {
+            'ok': stats['ok'], 'failed': stats['failed'],
+            'avg_s': round(stats['total_time'] / calls, 2) if calls else 0.0,
+            'histogram': {label: count for label, count in zip(labels, stats['buckets']) if count},
+        }
+    return result
+
+
+async def _request_provider(provider, api_key, prompt):
+    settings = PROVIDERS[provider]
+    client = get_client(provider, api_key)
+    if settings['kind'] == 'gemini':
+        response = await asyncio.wait_for(client.generate_content_async(prompt), _request_timeout)
+        reply = response.text
+    else:
+        completion = await client.chat.completions.create(messages=[{"role": "user", "content": prompt}],
+                                                          model=settings['model'])
+        reply = completion.choices[0].message.content
+    if not reply or not reply.strip():
+        raise ValueError("пустой ответ")
+    return reply
+
+
+async def _call_provider(provider, api_key, prompt):
+    estimated_tokens = _estimate_tokens(prompt)
+    for attempt in range(_max_retries + 1):
+        async with limiter.slot(provider, api_key, estimated_tokens):
+            started_at = time.monotonic()
+            try:
+                reply = await _request_provider(provider, api_key, prompt)
+            except asyncio.CancelledError:
+                # Отмененный запрос хеджирования в статистику не попадает.
+                raise
+            except Exception as e:
+                _record_latency(provider, time.monotonic() - started_at, False)
+                if attempt == _max_retries or not isinstance(e, RATE_LIMIT_ERRORS + TRANSIENT_ERRORS):
+                    raise
+                retry_after = None
+                if isinstance(e, RATE_LIMIT_ERRORS):
+                    retry_after = _retry_after(e)
+                    limiter.on_throttled(provider, retry_after)
+                delay = avito_api.RateGovernor.backoff_delay(attempt, retry_after, base=1.0, cap=60.0)
+                error_name = type(e).__name__
+            else:
+                _record_latency(provider, time.monotonic() - started_at, True)
+                limiter.on_success(provider)
+                return reply
+        logger.warning(f"Провайдер {provider}: {error_name}, повтор через {delay:.1f} сек.")
+        await asyncio.sleep(delay)
+
+
+async def generate_reply(history, api_key, provider, prompt_text):
+    if provider not in PROVIDERS:
+        logger.error(f"Неизвестный провайдер ИИ: {provider}")
+        return None
+    try:
+        return await _call_provider(provider, api_key, build_prompt(history, prompt_text))
+    except Exception as e:
+        logger.error(f"Ошибка генерации ответа через {provider}: {e}")
+        return None
+
+
+async def generate_reply_routed(history, api_keys, providers, prompt_text, hedge_delay=0):
+    # providers — порядок перебора. Ошибка провайдера сразу передает запрос следующему;
+    # при hedge_delay > 0 следующий запускается и тогда, когда текущий не ответил за это время.
+    candidates = [provider for provider in dict.fromkeys(providers) if provider in PROVIDERS and api_keys.get(provider)]
+    if not candidates:
+        logger.error(f"Нет доступных провайдеров ИИ среди {providers}")
+        return None, None
+
+    prompt = build_prompt(history, prompt_text)
+    pending = {}
+
+    def launch_next():
+        provider = candidates.pop(0)
+        task = asyncio.create_task(_call_provider(provider, api_keys[provider], prompt))
+        pending[task] = provider
+
+    launch_next()
+    try:
+        while pending:
+            timeout = hedge_delay if hedge_delay > 0 and candidates else None
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                logger.info(f"Провайдер {', '.join(pending.values())} не ответил за {hedge_delay} сек., "
+                            f"параллельно запрашиваю {candidates[0]}.")
+                launch_next()
+                continue
+            for task in done:
+                provider = pending.pop(task)
+                if task.exception() is None:
+                    return task.result(), provider
+                logger.warning(f"Провайдер {provider} не смог сгенерировать ответ: {task.exception()}")
+                if candidates:
+                    launch_next()
+        return None, None
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def stream_reply(history, api_key, provider, prompt_text):
+    # Отдает текст ответа частями по мере генерации; ошибки провайдера пробрасываются вызывающему.
+    if provider not in PROVIDERS:
+        raise ValueError(f"Неизвестный провайдер ИИ: {provider}")
+
+    prompt = build_prompt(history, prompt_text)
+    settings = PROVIDERS[provider]
+    client = get_client(provider, api_key)
+    async with limiter.slot(provider, api_key, _estimate_tokens(prompt)):
+        try:
+            if settings['kind'] == 'gemini':
+                response = await asyncio.wait_for(client.generate_content_async(prompt, stream=True),
+                                                  _request_timeout)
+                async for chunk in response:
+                    if chunk.text:
+                        yield chunk.text
+                return
+
+            stream = await client.chat.completions.create(messages=[{"role": "user", "content": prompt}],
+                                                          model=settings['model'], stream=True)
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        except RATE_LIMIT_ERRORS as e:
+            # Повтор на стороне пользователя, но лимит провайдера учитываем.
+            limiter.on_throttled(provider, _retry_after(e))
+            raise
+
+
+async def close():
+    global _http_client, _http_client_loop
+    _clients.clear()
+    if _http_client is not None and not _http_client.is_closed:
+        await _http_client.aclose()
+    _http_client = None
+    _http_client_loop = None
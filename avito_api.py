@@ -1,13 +1,34 @@
 import requests
+from requests.adapters import HTTPAdapter
 import logging
-import openai
-import google.generativeai as genai
 import json
 import time
 import os
+import random
+import threading
+from email.utils import parsedate_to_datetime
 
 logger = logging.getLogger(__name__)
 TOKEN_CACHE_FILE = 'avito_tokens.json'
+API_BASE_URL = 'https://api.avito.ru'
+# Сколько последних сообщений чата передается модели.
+CHAT_HISTORY_LIMIT = 10
+
+# Синхронный клиент оставлен для скриптов; бот работает через avito_client.
+POOL_MAXSIZE = 10
+_session = None
+_session_lock = threading.Lock()
+
+
+def _get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                session.mount(API_BASE_URL, HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE))
+                _session = session
+    return _session
 
 
 def _load_token_cache():
@@ -25,99 +46,334 @@ def _save_token_cache(cache):
         json.dump(cache, f, indent=2)
 
 
-def clear_token(client_id: str):
+TOKEN_REFRESH_MARGIN = 300
+_token_cache = None
+_token_cache_lock = threading.Lock()
+_token_refresh_locks = {}
+
+
+def _get_token_cache():
+    global _token_cache
+    if _token_cache is None:
+        with _token_cache_lock:
+            if _token_cache is None:
+                _token_cache = _load_token_cache()
+    return _token_cache
+
+
+def persist_token_cache():
+    cache = _get_token_cache()
+    with _token_cache_lock:
+        snapshot = dict(cache)
+    _save_token_cache(snapshot)
+
+
+def clear_token(client_id: str, persist=True):
     logger.warning(f"Принудительная очистка кэша токена для ID {client_id}.")
-    cache = _load_token_cache()
-    if client_id in cache:
-        del cache[client_id]
-        _save_token_cache(cache)
+    if _get_token_cache().pop(client_id, None) is not None and persist:
+        persist_token_cache()
 
 
-def get_token(client_id, client_secret):
-    cache = _load_token_cache()
+def get_cached_token(client_id):
+    entry = _get_token_cache().get(client_id)
+    if entry and entry.get('expires_at', 0) > time.time():
+        return entry['access_token']
+    return None
 
-    if client_id in cache and cache[client_id].get('expires_at', 0) > time.time():
-        logger.info(f"Используется кэшированный токен для ID {client_id}")
-        return cache[client_id]['access_token']
 
-    logger.info(f"Запрашивается новый токен для ID {client_id}")
-    url = "https://api.avito.ru/token/"
-    data = {'grant_type': 'client_credentials', 'client_id': client_id, 'client_secret': client_secret}
+def token_needs_refresh(client_id):
+    entry = _get_token_cache().get(client_id)
+    return not entry or entry.get('expires_at', 0) - TOKEN_REFRESH_MARGIN <= time.time()
 
-    try:
-        response = requests.post(url, data=data, timeout=10)
-        response.raise_for_status()
-        token_data = response.json()
 
-        access_token = token_data.get('access_token')
-        expires_in = token_data.get('expires_in', 3600)
+def store_token(client_id, token_data, persist=True):
+    access_token = token_data.get('access_token')
+    expires_in = token_data.get('expires_in', 3600)
+
+    _get_token_cache()[client_id] = {
+        'access_token': access_token,
+        'expires_at': time.time() + expires_in - 60
+    }
+    if persist:
+        persist_token_cache()
+    return access_token
+
+
+def token_request_data(client_id, client_secret):
+    return {'grant_type': 'client_credentials', 'client_id': client_id, 'client_secret': client_secret}
+
+
+class AvitoAPIError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class AvitoAuthError(AvitoAPIError):
+    pass
+
+
+class AvitoRateLimitError(AvitoAPIError):
+    def __init__(self, message, status=429, retry_after=None):
+        super().__init__(message, status)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None, min_rate=None):
+        self.max_rate = rate
+        self.min_rate = min_rate or rate / 10
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self, amount=1):
+        # Токен берется сразу, даже в долг: ожидание гарантировано, но долг задерживает всех следующих.
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(wait, self.blocked_until - now)
+
+    def wait_time(self, amount=1, headroom=0.0):
+        # Сколько ждать, пока токены можно взять без долга и не трогая запас headroom.
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            shortage = headroom + amount - self.tokens
+            return max(shortage / self.rate if shortage > 0 else 0.0, self.blocked_until - now)
+
+    def take(self, amount=1):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= amount
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.05)
+
+    def on_throttled(self, retry_after=None):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+
+
+class RateGovernor:
+    def __init__(self, client_rate=10.0, endpoint_rates=None, interactive_reserve=2.0):
+        self.client_rate = client_rate
+        self.endpoint_rates = endpoint_rates or {'token': 1.0, 'send': 3.0}
+        self.interactive_reserve = interactive_reserve
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self.throttled_count = 0
+
+    def configure(self, client_rate=None, endpoint_rates=None):
+        with self._lock:
+            if client_rate:
+                self.client_rate = client_rate
+            if endpoint_rates:
+                self.endpoint_rates.update(endpoint_rates)
+            self._buckets.clear()
+
+    def _bucket(self, key, rate):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(rate)
+            return bucket
+
+    def _buckets_for(self, client_id, endpoint):
+        buckets = [self._bucket((client_id,), self.client_rate)]
+        if endpoint in self.endpoint_rates:
+            buckets.append(self._bucket((client_id, endpoint), self.endpoint_rates[endpoint]))
+        return buckets
 
-        cache[client_id] = {
-            'access_token': access_token,
-            'expires_at': time.time() + expires_in - 60
-        }
-        _save_token_cache(cache)
+    def reserve(self, client_id, endpoint, interactive=True):
+        buckets = self._buckets_for(client_id, endpoint)
+        if interactive:
+            return max(bucket.reserve() for bucket in buckets)
+        # Фоновые запросы не уходят в долг и оставляют запас токенов ручным: при 0 токены взяты,
+        # иначе вызывающий ждет и спрашивает снова.
+        with self._lock:
+            wait = max(bucket.wait_time(headroom=self.interactive_reserve) for bucket in buckets)
+            if wait <= 0:
+                for bucket in buckets:
+                    bucket.take()
+            return wait
 
-        return access_token
+    def on_success(self, client_id, endpoint):
+        for bucket in self._buckets_for(client_id, endpoint):
+            bucket.on_success()
 
-    except requests.RequestException as e:
-        logger.error(f"Ошибка токена Avito для ID {client_id}: {e}")
+    def on_throttled(self, client_id, endpoint, retry_after=None):
+        self.throttled_count += 1
+        for bucket in self._buckets_for(client_id, endpoint):
+            bucket.on_throttled(retry_after)
+
+    @staticmethod
+    def backoff_delay(attempt, retry_after=None, base=0.5, cap=30.0):
+        if retry_after is not None:
+            return min(cap, retry_after) + random.uniform(0, base)
+        return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+rate_governor = RateGovernor()
+MAX_RETRIES = 3
+REQUEST_ERRORS = (requests.RequestException, AvitoAPIError)
+
+
+def parse_retry_after(value):
+    if not value:
         return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+def client_id_for_token(token):
+    for client_id, entry in list(_get_token_cache().items()):
+        if entry.get('access_token') == token:
+            return client_id
+    return None
+
+
+def check_response_status(status, headers, client_id, endpoint):
+    if status == 429:
+        retry_after = parse_retry_after(headers.get('Retry-After'))
+        rate_governor.on_throttled(client_id, endpoint, retry_after)
+        raise AvitoRateLimitError(f"Avito API ограничил частоту запросов ({endpoint})", retry_after=retry_after)
+    if status in (401, 403):
+        if client_id:
+            clear_token(client_id, persist=False)
+        raise AvitoAuthError(f"Avito API отклонил авторизацию ({endpoint}): HTTP {status}", status)
+    if status >= 500:
+        raise AvitoAPIError(f"Ошибка сервера Avito ({endpoint}): HTTP {status}", status)
+
+
+def _send(method, url, endpoint, token=None, client_id=None, retry_on_error=True, **kwargs):
+    client_id = client_id or client_id_for_token(token) or 'anonymous'
+    if token:
+        kwargs.setdefault('headers', {})['Authorization'] = f'Bearer {token}'
+    for attempt in range(MAX_RETRIES + 1):
+        wait = rate_governor.reserve(client_id, endpoint)
+        if wait > 0:
+            time.sleep(wait)
+        try:
+            response = _get_session().request(method, url, **kwargs)
+            check_response_status(response.status_code, response.headers, client_id, endpoint)
+            response.raise_for_status()
+            rate_governor.on_success(client_id, endpoint)
+            return response.json()
+        except AvitoRateLimitError as e:
+            if attempt == MAX_RETRIES:
+                raise
+            delay = rate_governor.backoff_delay(attempt, e.retry_after)
+        except (AvitoAPIError, requests.ConnectionError, requests.Timeout) as e:
+            if isinstance(e, AvitoAuthError) or not retry_on_error or attempt == MAX_RETRIES:
+                raise
+            delay = rate_governor.backoff_delay(attempt)
+        logger.warning(f"Повтор запроса к Avito ({endpoint}) через {delay:.1f} сек.")
+        time.sleep(delay)
+
+
+def get_token(client_id, client_secret):
+    if not token_needs_refresh(client_id):
+        return get_cached_token(client_id)
+
+    with _token_cache_lock:
+        refresh_lock = _token_refresh_locks.setdefault(client_id, threading.Lock())
+
+    with refresh_lock:
+        # Пока ждали блокировку, токен мог обновить другой поток.
+        if not token_needs_refresh(client_id):
+            return get_cached_token(client_id)
+
+        logger.info(f"Запрашивается новый токен для ID {client_id}")
+        url = f"{API_BASE_URL}/token/"
+
+        try:
+            token_data = _send('POST', url, 'token', client_id=client_id,
+                               data=token_request_data(client_id, client_secret), timeout=10)
+            return store_token(client_id, token_data)
+
+        except REQUEST_ERRORS as e:
+            logger.error(f"Ошибка токена Avito для ID {client_id}: {e}")
+            return get_cached_token(client_id)
 
 
 def get_chats(token, profile_id, limit=100, offset=0, unread_only=False):
-    url = f"https://api.avito.ru/messenger/v2/accounts/{profile_id}/chats"
-    headers = {'Authorization': f'Bearer {token}'}
+    url = f"{API_BASE_URL}/messenger/v2/accounts/{profile_id}/chats"
     params = {'limit': limit, 'offset': offset}
     if unread_only:
         params['unread_only'] = 'true'
 
     try:
-        response = requests.get(url, headers=headers, params=params, timeout=15)
-        response.raise_for_status()
-        return response.json().get('chats', [])
-    except requests.RequestException as e:
+        return _send('GET', url, 'chats', token, params=params, timeout=15).get('chats', [])
+    except REQUEST_ERRORS as e:
         logger.error(f"Ошибка при получении чатов для {profile_id}: {e}")
         # Возвращаем None в случае ошибки, чтобы внешний код мог ее обработать
         return None
 
 
+def get_chat(token, profile_id, chat_id):
+    url = f"{API_BASE_URL}/messenger/v2/accounts/{profile_id}/chats/{chat_id}"
+    try:
+        return _send('GET', url, 'chat', token, timeout=15)
+    except REQUEST_ERRORS as e:
+        logger.error(f"Ошибка при получении чата {chat_id}: {e}")
+        return None
+
+
 def get_messages(token, profile_id, chat_id):
-    url = f"https://api.avito.ru/messenger/v3/accounts/{profile_id}/chats/{chat_id}/messages"
-    headers = {'Authorization': f'Bearer {token}'}
+    url = f"{API_BASE_URL}/messenger/v3/accounts/{profile_id}/chats/{chat_id}/messages"
     try:
-        response = requests.get(url, headers=headers, timeout=15)
-        response.raise_for_status()
-        return response.json().get('messages', [])
-    except requests.RequestException as e:
+        return _send('GET', url, 'messages', token, timeout=15).get('messages', [])
+    except REQUEST_ERRORS as e:
         logger.error(f"Ошибка при получении сообщений для чата {chat_id}: {e}")
         return None
 
 
-def send_message(token, profile_id, chat_id, message_text):
+def send_message_payload(chat_id, message_text):
     if len(message_text) > 1990:
         logger.warning(f"Попытка отправить слишком длинное сообщение в чат {chat_id}. Усекаю.")
         message_text = message_text[:1990] + "..."
-
-    url = f"https://api.avito.ru/messenger/v1/accounts/{profile_id}/chats/{chat_id}/messages"
-    headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
-    payload = {
+    return {
         "message": {
             "text": message_text
         },
         "type": "text"
     }
+
+
+def send_message(token, profile_id, chat_id, message_text):
+    url = f"{API_BASE_URL}/messenger/v1/accounts/{profile_id}/chats/{chat_id}/messages"
+    payload = send_message_payload(chat_id, message_text)
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=15)
-        response.raise_for_status()
-        return response.json()
-    except requests.RequestException as e:
+        # Повторяем только отказы по лимиту: при ошибке сервера сообщение могло уйти.
+        return _send('POST', url, 'send', token, retry_on_error=False, json=payload, timeout=15)
+    except REQUEST_ERRORS as e:
         logger.error(f"Ошибка при отправке сообщения в чат {chat_id}: {e}")
         raise e
 
 
 def get_chat_history(token, profile_id, chat_id, limit=10):
-    messages = get_messages(token, profile_id, chat_id)
+    return format_chat_history(get_messages(token, profile_id, chat_id), limit)
+
+
+def format_chat_history(messages, limit=CHAT_HISTORY_LIMIT):
     if messages is None:
         return "Не удалось загрузить историю сообщений."
     history = ""
@@ -128,33 +384,14 @@ def get_chat_history(token, profile_id, chat_id, limit=10):
 
 
 async def generate_ai_reply(history, api_key, provider, prompt_text):
-    prompt = f"{prompt_text}\n\nНиже представлена история переписки с клиентом на Avito. Последнее сообщение от клиента. Сгенерируй короткий, вежливый и релевантный ответ от лица продавца.\n\nИстория:\n{history}"
-    try:
-        if provider == 'openai':
-            client = openai.AsyncOpenAI(api_key=api_key)
-            completion = await client.chat.completions.create(messages=[{"role": "user", "content": prompt}],
-                                                              model="gpt-4o")
-            return completion.choices[0].message.content
-        elif provider == 'gemini':
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel('gemini-1.5-flash')
-            response = await model.generate_content_async(prompt)
-            return response.text
-        elif provider == 'deepseek':
-            client = openai.AsyncOpenAI(api_key=api_key, base_url="https://api.deepseek.com")
-            completion = await client.chat.completions.create(messages=[{"role": "user", "content": prompt}],
-                                                              model="deepseek-chat")
-            return completion.choices[0].message.content
-    except Exception as e:
-        logger.error(f"Ошибка генерации ответа через {provider}: {e}")
-        return None
+    # Оставлено для совместимости: клиенты провайдеров живут в ai_client.
+    import ai_client
+    return await ai_client.generate_reply(history, api_key, provider, prompt_text)
 
 
 def subscribe_webhook(token, profile_id, webhook_url):
-    url = f"https://api.avito.ru/messenger/v3/webhook"
-    headers = {'Authorization': f'Bearer {token}', 'Content-Type': 'application/json'}
+    url = f"{API_BASE_URL}/messenger/v3/webhook"
     payload = {"url": webhook_url, "user_id": profile_id}
-    response = requests.post(url, headers=headers, json=payload, timeout=15)
-    response.raise_for_status()
+    data = _send('POST', url, 'webhook', token, json=payload, timeout=15)
     logger.info(f"Аккаунт {profile_id} успешно подписан на вебхук: {webhook_url}")
-    return response.json()
\ No newline at end of file
+    return data
\ No newline at end of file
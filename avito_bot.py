@@ -7,21 +7,25 @@ import html
 import json
 import re
 import asyncio
-import pandas as pd
-from openpyxl.utils import get_column_letter
-import io
 import sqlite3
 from datetime import datetime, timezone, timedelta
+from urllib.parse import urlencode
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ForceReply, ReplyKeyboardMarkup, \
     ReplyKeyboardRemove
 from telegram.ext import (Application, CommandHandler, ConversationHandler,
                           MessageHandler, filters, ContextTypes, CallbackQueryHandler)
 from telegram.constants import ParseMode
-from telegram.error import BadRequest
+from telegram.error import BadRequest, RetryAfter
 
 import database as db
 import avito_api as avito
+import avito_client
+import ai_client
+import ai_cache
+import chat_sync
+import history_backfill
+import stats_export
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -31,6 +35,8 @@ LAST_TIMESTAMPS_FILE = 'last_timestamps.json'
 STATUS_FILE = 'bot_status.json'
 AI_SETTINGS_FILE = 'ai_settings.json'
 ITEMS_PER_PAGE = 5
+TELEGRAM_DOCUMENT_LIMIT = 50 * 1024 * 1024
+TELEGRAM_PREVIEW_LIMIT = 4000
 CANCEL_KEYBOARD = ReplyKeyboardMarkup([['/cancel']], resize_keyboard=True, one_time_keyboard=True)
 
 (
@@ -101,6 +107,124 @@ def escape_markdown_v2(text: str) -> str:
     return re.sub(f'([{re.escape(escape_chars)}])', r'\\\1', text)
 
 
+class AsyncRateLimiter:
+    def __init__(self, rate_per_second: float):
+        self._interval = 1 / rate_per_second if rate_per_second > 0 else 0
+        self._next_slot = 0.0
+
+    async def wait(self):
+        now = asyncio.get_running_loop().time()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + self._interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+def _chat_state_row(chat):
+    last_message = chat.get('last_message', {})
+    direction = last_message.get('direction')
+    is_unread = direction == 'in' and not last_message.get('read')
+    return chat['id'], last_message.get('created', 0), direction, is_unread
+
+
+def _select_changed_chats(chats, watermarks):
+    changed_chats = []
+    handled_states = []
+    for chat in chats:
+        chat_id, last_message_ts, direction, is_unread = _chat_state_row(chat)
+        last_known_ts = watermarks.get(chat_id)
+
+        if last_known_ts is not None and last_message_ts <= last_known_ts:
+            continue
+
+        if direction != 'in':
+            # Последнее сообщение исходящее: чат уже обработан, просто сдвигаем отметку.
+            handled_states.append((chat_id, last_message_ts, direction, is_unread))
+            continue
+
+        changed_chats.append(chat)
+    return changed_chats, handled_states
+
+
+def _store_sent_message(account_id, chat_id_avito, response, text):
+    # Отправленный ответ сразу попадает в локальный индекс, иначе поиск по синхронизированному чату его не найдет.
+    msg = {'created': int(time.time()), 'direction': 'out', 'type': 'text', 'content': {'text': text}}
+    if isinstance(response, dict):
+        msg.update({key: response[key] for key in ('id', 'created') if response.get(key)})
+    try:
+        db.store_messages(account_id, chat_id_avito, [msg])
+    except sqlite3.Error as e:
+        logger.warning(f"Не удалось сохранить отправленное сообщение чата {chat_id_avito} в индекс: {e}")
+
+
+async def _fetch_chats_messages(token, profile_id, chats, max_in_flight, rate_limiter):
+    semaphore = asyncio.Semaphore(max_in_flight)
+
+    async def fetch(chat):
+        async with semaphore:
+            await rate_limiter.wait()
+            return await avito_client.get_messages(token, profile_id, chat['id'])
+
+    return await asyncio.gather(*(fetch(chat) for chat in chats), return_exceptions=True)
+
+
+async def _notify_incoming_message(context, account, chat, msg, ai_settings):
+    chat_id_avito = chat['id']
+    msg_ts = msg.get('created', 0)
+    if msg.get('type') != 'text':
+        logger.info(f"Пропущено системное сообщение типа '{msg.get('type')}' в чате {chat_id_avito}")
+        return
+
+    text = msg.get('content', {}).get('text', '')
+    user_info = (chat.get('users') or [{}])[0]
+    author_name = user_info.get('name', 'Неизвестно')
+    author_id = user_info.get('id', 'N/A')
+    author_str = f"{author_name} ({author_id})"
+    ad_context = chat.get('context', {}).get('value', {})
+    ad_title = ad_context.get('title', 'Не указано')
+    msg_datetime = datetime.fromtimestamp(msg_ts, timezone.utc) + timedelta(hours=3)
+    date_str = msg_datetime.strftime('%d.%m.%Y, %H:%M')
+
+    message_text = (
+        f"📬 *Новое сообщение для «{escape_markdown_v2(account['name'])}»*\n\n"
+        f"*От:* {escape_markdown_v2(author_str)}\n"
+        f"*Объявление:* {escape_markdown_v2(ad_title)}\n\n"
+        f"*Текст:* {escape_markdown_v2(text)}\n"
+        f"*Дата:* {escape_markdown_v2(date_str)}"
+    )
+
+    db.log_message(account['id'], chat_id_avito, 'in', None, text)
+    reply_markup = _build_chat_interaction_keyboard(account, chat_id_avito)
+
+    sent_message = await context.bot.send_message(
+        chat_id=account['notification_chat_id'],
+        text=message_text,
+        parse_mode='MarkdownV2',
+        reply_markup=reply_markup
+    )
+    db.upsert_chat_state(account['id'], chat_id_avito, msg_ts, 'in', True)
+    logger.info(f"Сообщение из чата {chat_id_avito} переслано в Telegram.")
+
+    if account['ai_mode'] > 0:
+        delay_minutes = account.get('ai_reply_delay') or ai_settings.get('global_ai_reply_delay', 1)
+        delay_seconds = int(delay_minutes) * 60
+
+        logger.info(f"Планирую авто-ответ для чата {chat_id_avito} через {delay_minutes} мин.")
+        job_data = {
+            "account_id": account['id'],
+            "chat_id_avito": chat_id_avito,
+            "item_id": ad_context.get('id'),
+            "reply_to_message_id": sent_message.message_id
+        }
+        job_name = f"ai_reply_{chat_id_avito}"
+        current_jobs = context.job_queue.get_jobs_by_name(job_name)
+        for job in current_jobs:
+            job.schedule_removal()
+        context.job_queue.run_once(ai_auto_reply_job, delay_seconds, data=job_data, name=job_name)
+
+    await asyncio.sleep(1)
+
+
 async def check_avito_messages(context: ContextTypes.DEFAULT_TYPE):
     status_data = load_json(STATUS_FILE, {'status': 'stopped'})
     if status_data.get('status') != 'running':
@@ -108,162 +232,215 @@ async def check_avito_messages(context: ContextTypes.DEFAULT_TYPE):
         return
 
     logger.info("Начинаю проверку сообщений Avito...")
-    last_timestamps = load_json(LAST_TIMESTAMPS_FILE)
     active_accounts = db.get_accounts(active_only=True)
     ai_settings = load_json(AI_SETTINGS_FILE, {})
 
-    active_period_days = int(context.bot_data['config']['SETTINGS'].get('ACTIVE_PERIOD_DAYS', 30))
+    settings = context.bot_data['config']['SETTINGS']
+    active_period_days = int(settings.get('ACTIVE_PERIOD_DAYS', 30))
     archive_boundary_ts = int(time.time()) - (active_period_days * 24 * 60 * 60)
 
-    for account in active_accounts:
-        account_name = account['name']
-        account_id_str = str(account['id'])
-        token = await asyncio.to_thread(avito.get_token, account['client_id'], account['client_secret'])
+    max_concurrency = int(settings.get('POLL_MAX_CONCURRENCY', 10))
+    max_per_client = int(settings.get('POLL_MAX_PER_CLIENT', 2))
+    account_timeout = int(settings.get('ACCOUNT_POLL_TIMEOUT', 120))
 
-        if not token:
+    global_semaphore = asyncio.Semaphore(max_concurrency)
+    client_semaphores = {}
+
+    async def poll_account(account):
+        client_semaphore = client_semaphores.setdefault(account['client_id'], asyncio.Semaphore(max_per_client))
+        async with global_semaphore, client_semaphore:
             try:
-                await context.bot.send_message(
-                    chat_id=context.bot_data['config']['TELEGRAM']['ALLOWED_USER_IDS'].split(',')[0].strip(),
-                    text=f"⚠️ Ошибка получения токена Avito для аккаунта «{account_name}»! Проверьте Client ID и Secret.")
-            except Exception as bot_e:
-                logger.error(f"Не удалось отправить уведомление об ошибке токена: {bot_e}")
-            continue
+                await asyncio.wait_for(
+                    _check_account_messages(context, account, ai_settings, archive_boundary_ts),
+                    timeout=account_timeout)
+            except asyncio.TimeoutError:
+                logger.error(f"Проверка аккаунта '{account['name']}' прервана по таймауту ({account_timeout} сек.).")
+            except Exception as e:
+                logger.error(f"Ошибка при проверке аккаунта '{account['name']}': {e}", exc_info=True)
 
-        stop_fetching = False
-        offset = 0
-        limit = 50
-        recent_chats_list = []
+    avito_client.size_pool_for_accounts(min(len(active_accounts), max_concurrency),
+                                        int(settings.get('CHAT_FETCH_CONCURRENCY', 5)))
+    await asyncio.gather(*(poll_account(account) for account in active_accounts))
+    db.prune_notified_messages(archive_boundary_ts)
+    logger.info(f"Проверка сообщений завершена. Пул соединений Avito: {avito_client.get_pool_stats()}, "
+                f"кэш AI-ответов: {ai_cache.reply_cache.get_stats()}, провайдеры ИИ: {ai_client.get_stats()}, "
+                f"очередь статистики: {db.stats_writer.pending()}")
 
-        while not stop_fetching:
-            chats_batch = await asyncio.to_thread(avito.get_chats, token, account['profile_id'], limit, offset)
 
-            if chats_batch is None:
-                logger.warning(
-                    f"Ошибка API при получении чатов для '{account_name}'. Возможно, токен невалиден. Очищаю кэш.")
-                await asyncio.to_thread(avito.clear_token, account['client_id'])
-                break
+async def _check_account_messages(context: ContextTypes.DEFAULT_TYPE, account, ai_settings, archive_boundary_ts):
+    account_name = account['name']
+    account_id_str = str(account['id'])
+    token = await avito_client.get_token(account['client_id'], account['client_secret'])
 
-            if not chats_batch:
-                break
+    if not token:
+        try:
+            await context.bot.send_message(
+                chat_id=context.bot_data['config']['TELEGRAM']['ALLOWED_USER_IDS'].split(',')[0].strip(),
+                text=f"⚠️ Ошибка получения токена Avito для аккаунта «{account_name}»! Проверьте Client ID и Secret.")
+        except Exception as bot_e:
+            logger.error(f"Не удалось отправить уведомление об ошибке токена: {bot_e}")
+        return
 
-            for chat in chats_batch:
-                last_message_ts = chat.get('last_message', {}).get('created', 0)
-                if last_message_ts < archive_boundary_ts:
-                    stop_fetching = True
-                    break
-                recent_chats_list.append(chat)
+    recent_chats_list = await chat_sync.synchronizer.sync(token, account, archive_boundary_ts)
+    if not recent_chats_list:
+        return
 
-            if len(chats_batch) < limit:
-                break
-            offset += limit
+    unanswered_count = sum(1 for chat in recent_chats_list if chat.get('last_message', {}).get('direction') == 'in')
+    context.bot_data[f"unanswered_count_{account_id_str}"] = unanswered_count
+    logger.info(
+        f"Аккаунт '{account_name}': Найдено {len(recent_chats_list)} активных чатов. ({unanswered_count} неотвеченных).")
+
+    if not db.has_chat_state(account['id']):
+        db.upsert_chat_states(account['id'], [_chat_state_row(chat) for chat in recent_chats_list])
+        logger.info(f"Первичная настройка для аккаунта '{account_name}' завершена.")
+        return
+
+    watermarks = db.get_chat_watermarks(account['id'], [chat['id'] for chat in recent_chats_list])
+    changed_chats, handled_states = _select_changed_chats(recent_chats_list, watermarks)
+    db.upsert_chat_states(account['id'], handled_states)
+    # Исходящие сообщения из приложения Avito берем из списка чатов, не запрашивая переписку.
+    handled_chat_ids = {state[0] for state in handled_states}
+    for chat in recent_chats_list:
+        if chat['id'] in handled_chat_ids and chat.get('last_message'):
+            db.store_messages(account['id'], chat['id'], [chat['last_message']])
+    logger.info(f"Аккаунт '{account_name}': {len(changed_chats)} чатов с новыми входящими сообщениями.")
+
+    settings = context.bot_data['config']['SETTINGS']
+    fetched_chats = await _fetch_chats_messages(
+        token, account['profile_id'], changed_chats,
+        max_in_flight=int(settings.get('CHAT_FETCH_CONCURRENCY', 5)),
+        rate_limiter=AsyncRateLimiter(float(settings.get('CHAT_FETCH_RATE', 10)))
+    )
+
+    for chat, messages in zip(changed_chats, fetched_chats):
+        chat_id_avito = chat['id']
+        try:
+            if isinstance(messages, BaseException):
+                raise messages
+            if messages is None:
+                logger.warning(f"Не удалось получить сообщения для чата {chat_id_avito}, пропуск.")
+                continue
+            db.store_messages(account['id'], chat_id_avito, messages, mark_synced=True)
+
+            incoming_messages = sorted(
+                [msg for msg in messages if msg.get('direction') == 'in'],
+                key=lambda x: x.get('created', 0)
+            )
+
+            # Отметка времени отсекает старую переписку, а учет уведомлений — сообщения,
+            # уже обработанные вебхуком или прошлым опросом.
+            last_known_ts = watermarks.get(chat_id_avito, 0)
+            candidates = [msg for msg in incoming_messages if msg.get('created', 0) >= last_known_ts]
+            claimed_keys = db.claim_notifications(account['id'], chat_id_avito, candidates)
+            new_messages = [msg for msg in candidates if db.message_key(msg) in claimed_keys]
+
+            for msg in new_messages:
+                await _notify_incoming_message(context, account, chat, msg, ai_settings)
 
-        if not recent_chats_list and offset == 0:
+            db.upsert_chat_state(account['id'], *_chat_state_row(chat))
+        except Exception as e:
+            logger.warning(f"Не удалось обработать чат {chat_id_avito}: {e}")
             continue
 
-        unanswered_count = sum(1 for chat in recent_chats_list if chat.get('last_message', {}).get('direction') == 'in')
-        context.bot_data[f"unanswered_count_{account_id_str}"] = unanswered_count
-        logger.info(
-            f"Аккаунт '{account_name}': Найдено {len(recent_chats_list)} активных чатов. ({unanswered_count} неотвеченных).")
 
-        account_timestamps = last_timestamps.setdefault(account_id_str, {})
-        is_initial_run = not bool(account_timestamps)
+async def history_backfill_job(context: ContextTypes.DEFAULT_TYPE):
+    status_data = load_json(STATUS_FILE, {'status': 'stopped'})
+    if status_data.get('status') != 'running':
+        return
 
-        for chat in recent_chats_list:
-            chat_id_avito = chat['id']
-            try:
-                new_messages = []
-                time.sleep(0.2)
-
-                messages = await asyncio.to_thread(avito.get_messages, token, account['profile_id'], chat_id_avito)
-                if messages is None:
-                    logger.warning(f"Не удалось получить сообщения для чата {chat_id_avito}, пропуск.")
-                    continue
-
-                incoming_messages = sorted(
-                    [msg for msg in messages if msg.get('direction') == 'in'],
-                    key=lambda x: x.get('created', 0)
-                )
-
-                if not incoming_messages:
-                    continue
-
-                last_message_ts = incoming_messages[-1].get('created', 0)
-                last_known_ts = account_timestamps.get(chat_id_avito, 0)
-
-                if is_initial_run:
-                    account_timestamps[chat_id_avito] = last_message_ts
-                    continue
-
-                if last_message_ts <= last_known_ts:
-                    continue
-
-                new_messages = [msg for msg in incoming_messages if msg.get('created', 0) > last_known_ts]
-
-                if new_messages:
-                    for msg in new_messages:
-                        if msg.get('type') != 'text':
-                            logger.info(
-                                f"Пропущено системное сообщение типа '{msg.get('type')}' в чате {chat_id_avito}")
-                            continue
-
-                        text = msg.get('content', {}).get('text', '')
-                        user_info = chat.get('users', [{}])[0]
-                        author_name = user_info.get('name', 'Неизвестно')
-                        author_id = user_info.get('id', 'N/A')
-                        author_str = f"{author_name} ({author_id})"
-                        ad_context = chat.get('context', {}).get('value', {})
-                        ad_title = ad_context.get('title', 'Не указано')
-                        msg_datetime = datetime.fromtimestamp(msg.get('created', 0), timezone.utc) + timedelta(hours=3)
-                        date_str = msg_datetime.strftime('%d.%m.%Y, %H:%M')
-
-                        message_text = (
-                            f"📬 *Новое сообщение для «{escape_markdown_v2(account_name)}»*\n\n"
-                            f"*От:* {escape_markdown_v2(author_str)}\n"
-                            f"*Объявление:* {escape_markdown_v2(ad_title)}\n\n"
-                            f"*Текст:* {escape_markdown_v2(text)}\n"
-                            f"*Дата:* {escape_markdown_v2(date_str)}"
-                        )
-
-                        db.log_message(account['id'], chat_id_avito, 'in', None, text)
-                        reply_markup = _build_chat_interaction_keyboard(account, chat_id_avito)
-
-                        sent_message = await context.bot.send_message(
-                            chat_id=account['notification_chat_id'],
-                            text=message_text,
-                            parse_mode='MarkdownV2',
-                            reply_markup=reply_markup
-                        )
-                        logger.info(f"Сообщение из чата {chat_id_avito} переслано в Telegram.")
-
-                        if account['ai_mode'] > 0:
-                            delay_minutes = account.get('ai_reply_delay') or ai_settings.get('global_ai_reply_delay', 1)
-                            delay_seconds = int(delay_minutes) * 60
-
-                            logger.info(f"Планирую авто-ответ для чата {chat_id_avito} через {delay_minutes} мин.")
-                            job_data = {
-                                "account_id": account['id'],
-                                "chat_id_avito": chat_id_avito,
-                                "reply_to_message_id": sent_message.message_id
-                            }
-                            job_name = f"ai_reply_{chat_id_avito}"
-                            current_jobs = context.job_queue.get_jobs_by_name(job_name)
-                            for job in current_jobs:
-                                job.schedule_removal()
-                            context.job_queue.run_once(ai_auto_reply_job, delay_seconds, data=job_data, name=job_name)
-
-                        await asyncio.sleep(1)
-
-                account_timestamps[chat_id_avito] = last_message_ts
+    settings = context.bot_data['config']['SETTINGS']
+    active_period_days = int(settings.get('ACTIVE_PERIOD_DAYS', 30))
+    archive_boundary_ts = int(time.time()) - (active_period_days * 24 * 60 * 60)
 
-            except Exception as e:
-                logger.warning(f"Не удалось обработать чат {chat_id_avito}: {e}")
+    backfill = history_backfill.backfill
+    backfill.request_budget = int(settings.get('BACKFILL_REQUEST_BUDGET', 50))
+    backfill.pause_threshold = int(settings.get('BACKFILL_PAUSE_THRESHOLD', 2))
+    try:
+        await backfill.run(db.get_accounts(active_only=True), archive_boundary_ts)
+    except Exception as e:
+        logger.error(f"Ошибка фоновой загрузки истории: {e}", exc_info=True)
+
+
+async def handle_webhook_message(application: Application, account, chat_id_avito, msg):
+    status_data = load_json(STATUS_FILE, {'status': 'stopped'})
+    if status_data.get('status') != 'running' or not account['is_active']:
+        return
+
+    db.store_messages(account['id'], chat_id_avito, [msg])
+    if msg['direction'] != 'in':
+        db.upsert_chat_state(account['id'], chat_id_avito, msg['created'], 'out', False)
+        return
+    if not db.claim_notifications(account['id'], chat_id_avito, [msg]):
+        # Сообщение уже получено опросом.
+        return
+
+    try:
+        token = await avito_client.get_token(account['client_id'], account['client_secret'])
+        chat = None
+        if token:
+            chat = await avito_client.get_chat(token, account['profile_id'], chat_id_avito)
+        chat = chat or {'id': chat_id_avito}
+
+        ai_settings = load_json(AI_SETTINGS_FILE, {})
+        await _notify_incoming_message(application, account, chat, msg, ai_settings)
+    except Exception as e:
+        logger.error(f"Не удалось обработать событие вебхука для чата {chat_id_avito}: {e}", exc_info=True)
+
+
+async def _start_webhook(application: Application):
+    import avito_webhook
+
+    webhook_config = application.bot_data['config']['WEBHOOK']
+    path = webhook_config.get('PATH', '/avito/webhook')
+    secret = webhook_config['SECRET'].strip()
+
+    async def on_message(account, chat_id_avito, msg):
+        # Перечитываем аккаунт, чтобы учитывать актуальные настройки автоответа.
+        account = db.get_account_by_id(account['id']) or account
+        await handle_webhook_message(application, account, chat_id_avito, msg)
+
+    application.bot_data['webhook_runner'] = await avito_webhook.start_webhook_server(
+        webhook_config.get('HOST', '0.0.0.0'), int(webhook_config.get('PORT', 8080)), path, secret, on_message)
+
+    public_url = f"{webhook_config['PUBLIC_URL'].rstrip('/')}{path}?{urlencode({'token': secret})}"
+    for account in db.get_accounts(active_only=True):
+        try:
+            token = await avito_client.get_token(account['client_id'], account['client_secret'])
+            if not token:
+                logger.error(f"Вебхук: не удалось получить токен для '{account['name']}'")
                 continue
+            await avito_client.subscribe_webhook(token, account['profile_id'], public_url)
+        except Exception as e:
+            logger.error(f"Не удалось подписать аккаунт '{account['name']}' на вебхук: {e}")
+
+
+async def _stop_webhook(application: Application):
+    runner = application.bot_data.pop('webhook_runner', None)
+    if runner:
+        import avito_webhook
+        await avito_webhook.stop_webhook_server(runner)
+
+
+async def post_init(application: Application):
+    if is_webhook_enabled(application.bot_data['config']):
+        await _start_webhook(application)
 
-        if is_initial_run:
-            logger.info(f"Первичная настройка для аккаунта '{account_name}' завершена.")
 
-        save_json(LAST_TIMESTAMPS_FILE, last_timestamps)
-    logger.info("Проверка сообщений завершена.")
+async def post_shutdown(application: Application):
+    await _stop_webhook(application)
+    await avito_client.close()
+    await ai_client.close()
+    await asyncio.to_thread(db.stop_stats_writer)
+
+
+def is_webhook_enabled(config) -> bool:
+    if not config.has_section('WEBHOOK') or not config['WEBHOOK'].getboolean('ENABLED', fallback=False):
+        return False
+    if not config['WEBHOOK'].get('SECRET', '').strip():
+        logger.critical("Вебхук отключен: не задан SECRET в секции [WEBHOOK]. Сообщения проверяются опросом.")
+        return False
+    return True
+
 
 async def _send_automation_settings_menu(chat_id: int, context: ContextTypes.DEFAULT_TYPE, message_id: int = None):
     account_id = context.user_data.get('account_id')
@@ -375,26 +552,27 @@ async def _send_templates_main_menu(chat_id: int, context: ContextTypes.DEFAULT_
         await context.bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
 
 
+@avito_client.with_priority(avito_client.PRIORITY_AUTO_REPLY)
 async def ai_auto_reply_job(context: ContextTypes.DEFAULT_TYPE):
     job_data = context.job.data
     account_id = job_data['account_id']
     chat_id_avito = job_data['chat_id_avito']
     reply_to_message_id = job_data.get('reply_to_message_id')
+    item_id = job_data.get('item_id')
 
     account = db.get_account_by_id(account_id)
     if not account or not account['is_active'] or account['ai_mode'] == 0:
         logger.info(f"AI Auto-Reply отменен: аккаунт {account_id} неактивен или режим выключен.")
         return
 
-    token = await asyncio.to_thread(avito.get_token, account['client_id'], account['client_secret'])
+    token = await avito_client.get_token(account['client_id'], account['client_secret'])
     if not token:
         logger.error(f"AI Auto-Reply: Не удалось получить токен для {account['name']}")
         return
 
-    messages = await asyncio.to_thread(avito.get_messages, token, account['profile_id'], chat_id_avito)
+    messages = await avito_client.get_messages(token, account['profile_id'], chat_id_avito)
     if messages is None:
         logger.warning(f"AI Auto-Reply: не удалось получить сообщения для чата {chat_id_avito}, отмена.")
-        await asyncio.to_thread(avito.clear_token, account['client_id'])
         return
 
     last_message = sorted(messages, key=lambda x: x.get('created', 0))[-1]
@@ -426,21 +604,47 @@ async def ai_auto_reply_job(context: ContextTypes.DEFAULT_TYPE):
 
     elif account['ai_mode'] in [1, 2]:
         settings = load_json(AI_SETTINGS_FILE, {})
-        api_key = settings.get('api_keys', {}).get(account['ai_provider'])
-        if not api_key:
-            logger.error(f"AI Auto-Reply: API ключ для {account['ai_provider']} не найден.")
+        api_keys = settings.get('api_keys', {})
+        bot_settings = context.bot_data['config']['SETTINGS']
+        providers = _ai_provider_order(account, bot_settings)
+        if not any(api_keys.get(provider) for provider in providers):
+            logger.error(f"AI Auto-Reply: API ключи для {', '.join(providers)} не найдены.")
             return
 
         prompt_text = account.get('prompt_text_full') or DEFAULT_PROMPT
         if account['ai_mode'] == 1 and account.get('prompt_text_limited'):
             prompt_text = account['prompt_text_limited']
 
-        history = await asyncio.to_thread(avito.get_chat_history, token, account['profile_id'], chat_id_avito)
-        ai_response = await avito.generate_ai_reply(history, api_key, account['ai_provider'], prompt_text)
-
-        if not ai_response or not ai_response.strip():
-            logger.error(f"AI Auto-Reply: Получен пустой ответ для чата {chat_id_avito}")
-            return
+        cache_enabled = bot_settings.get('AI_CACHE_ENABLED', 'true').lower() == 'true'
+        ai_response = None
+        if cache_enabled:
+            ai_response = ai_cache.reply_cache.get(account_id, item_id, account['ai_provider'], prompt_text, messages)
+            if ai_response:
+                logger.info(f"AI Auto-Reply: ответ для чата {chat_id_avito} взят из кэша.")
+
+        if not ai_response:
+            # Сообщения уже загружены выше, повторный запрос истории не нужен.
+            history = avito.format_chat_history(messages)
+            ai_response, used_provider = await ai_client.generate_reply_routed(
+                history, api_keys, providers, prompt_text, hedge_delay=float(bot_settings.get('AI_HEDGE_DELAY', 0)))
+
+            if not ai_response:
+                logger.error(f"AI Auto-Reply: ни один провайдер не сгенерировал ответ для чата {chat_id_avito}")
+                try:
+                    await context.bot.send_message(
+                        chat_id=account['notification_chat_id'],
+                        text=f"⚠️ ИИ не смог сгенерировать автоответ для «{account['name']}» "
+                             f"(провайдеры: {', '.join(providers)}). Ответьте клиенту вручную.",
+                        reply_to_message_id=reply_to_message_id
+                    )
+                except Exception as e:
+                    logger.error(f"Не удалось отправить уведомление об ошибке автоответа: {e}")
+                return
+            if used_provider != account['ai_provider']:
+                logger.info(f"AI Auto-Reply: ответ для чата {chat_id_avito} получен от резервного провайдера {used_provider}.")
+            if cache_enabled:
+                ai_cache.reply_cache.put(account_id, item_id, account['ai_provider'], prompt_text, messages,
+                                         ai_response)
 
         response_text = ai_response
         reply_type = 'ai'
@@ -450,7 +654,8 @@ async def ai_auto_reply_job(context: ContextTypes.DEFAULT_TYPE):
         return
 
     try:
-        await asyncio.to_thread(avito.send_message, token, account['profile_id'], chat_id_avito, response_text)
+        sent = await avito_client.send_message(token, account['profile_id'], chat_id_avito, response_text)
+        _store_sent_message(account['id'], chat_id_avito, sent, response_text)
         db.log_message(account['id'], chat_id_avito, 'out', reply_type, response_text)
     except Exception as e:
         logger.error(f"Авто-ответ: Не удалось отправить сообщение в чат Avito {chat_id_avito}: {e}")
@@ -467,6 +672,12 @@ async def ai_auto_reply_job(context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Не удалось отправить уведомление об авто-ответе менеджеру в Telegram: {e}")
 
 
+def _ai_provider_order(account, bot_settings):
+    # Сначала провайдер аккаунта, затем резервные из config.ini.
+    fallbacks = [p.strip() for p in bot_settings.get('AI_FALLBACK_PROVIDERS', '').split(',') if p.strip()]
+    return list(dict.fromkeys([account['ai_provider'], *fallbacks]))
+
+
 def is_allowed(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     allowed_ids = [int(uid.strip()) for uid in context.bot_data['config']['TELEGRAM']['ALLOWED_USER_IDS'].split(',')]
     return update.effective_user.id in allowed_ids
@@ -478,6 +689,21 @@ def get_paginated_items(items, page, items_per_page=ITEMS_PER_PAGE):
     return items[start_idx:end_idx], len(items)
 
 
+async def get_dashboard_data(context: ContextTypes.DEFAULT_TYPE):
+    # Кэш общий для всех пользователей; изменение аккаунтов или шаблонов сбрасывает его сразу.
+    cache = context.bot_data.get('dashboard_cache')
+    now = time.monotonic()
+    settings_version = db.get_settings_version()
+    if cache and cache['expires_at'] > now and cache['settings_version'] == settings_version:
+        return cache['rows']
+
+    rows = await asyncio.to_thread(db.get_dashboard_rows)
+    ttl = float(context.bot_data['config']['SETTINGS'].get('DASHBOARD_CACHE_TTL', 10))
+    context.bot_data['dashboard_cache'] = {'rows': rows, 'expires_at': now + ttl,
+                                           'settings_version': settings_version}
+    return rows
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_allowed(update, context):
         await update.message.reply_text("❌ Доступ запрещен.")
@@ -492,16 +718,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     toggle_button_text = "⏹️ Остановить" if is_running else "▶️ Запустить"
     toggle_button_callback = "stop_polling" if is_running else "start_polling"
 
-    all_accounts = db.get_accounts()
-    active_accounts = [acc for acc in all_accounts if acc['is_active']]
-    stats_today = db.get_stats_for_period('day')
+    active_accounts = await get_dashboard_data(context)
 
     account_info_blocks = []
     if active_accounts:
         for acc in active_accounts:
             acc_id_str = str(acc['id'])
-            received = sum(1 for log in stats_today if log['account_id'] == acc['id'] and log['direction'] == 'in')
-            replied = sum(1 for log in stats_today if log['account_id'] == acc['id'] and log['direction'] == 'out')
+            received = acc['received']
+            replied = acc['replied']
             unanswered = context.bot_data.get(f"unanswered_count_{acc_id_str}", "...")
 
             ai_mode_map = {
@@ -510,10 +734,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             }
             ai_status_text = ai_mode_map.get(acc.get('ai_mode', 0), "⚪️")
 
-            template_count = 0
-            if acc.get('default_category_id'):
-                templates_in_category = db.get_canned_responses_by_category(acc['default_category_id'])
-                template_count = len(templates_in_category)
+            template_count = acc['template_count']
 
             account_name = html.escape(acc.get('name', 'Безымянный'))
 
@@ -812,6 +1033,7 @@ async def delete_account_execute(update: Update, context: ContextTypes.DEFAULT_T
     query = update.callback_query
     account_id = int(query.data.split('_')[-1])
     db.delete_account(account_id)
+    chat_sync.synchronizer.forget(account_id)
     await query.answer("Аккаунт успешно удален", show_alert=True)
     context.user_data.pop('account_id', None)
     return await my_accounts_menu(update, context)
@@ -827,6 +1049,8 @@ async def toggle_account_settings(update: Update, context: ContextTypes.DEFAULT_
     if acc:
         new_status = not acc['is_active']
         db.update_account(account_id, 'is_active', new_status)
+        if not new_status:
+            chat_sync.synchronizer.forget(account_id)
         try:
             await query.answer("Статус обновлен", show_alert=False)
         except BadRequest:
@@ -876,6 +1100,8 @@ async def save_account_field(update: Update, context: ContextTypes.DEFAULT_TYPE)
             return EDIT_ACCOUNT_FIELD
 
     db.update_account(account_id, field, new_value)
+    if field in ('client_id', 'client_secret', 'profile_id'):
+        chat_sync.synchronizer.forget(account_id)
     await update.message.reply_text("✅ Данные обновлены.", reply_markup=ReplyKeyboardRemove())
 
     context.user_data.pop('editing_field', None)
@@ -1203,6 +1429,7 @@ async def restore_original_buttons(update: Update, context: ContextTypes.DEFAULT
     original_keyboard = _build_chat_interaction_keyboard(account, avito_chat_id)
     await query.edit_message_reply_markup(reply_markup=original_keyboard)
 
+@avito_client.with_priority(avito_client.PRIORITY_INTERACTIVE)
 async def request_chat_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     try:
@@ -1219,13 +1446,13 @@ async def request_chat_history(update: Update, context: ContextTypes.DEFAULT_TYP
         await query.message.reply_text("❌ Аккаунт не найден.")
         return
 
-    token = await asyncio.to_thread(avito.get_token, account['client_id'], account['client_secret'])
+    token = await avito_client.get_token(account['client_id'], account['client_secret'])
     if not token:
         await query.message.reply_text("❌ Ошибка авторизации Avito.")
         return
 
     try:
-        history = await asyncio.to_thread(avito.get_chat_history, token, account['profile_id'], avito_chat_id)
+        history = await avito_client.get_chat_history(token, account['profile_id'], avito_chat_id)
         if not history:
             history = "В этом чате пока нет сообщений."
 
@@ -1258,6 +1485,7 @@ async def manual_reply_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
     return AWAITING_MANUAL_REPLY
 
 
+@avito_client.with_priority(avito_client.PRIORITY_INTERACTIVE)
 async def manual_reply_process(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reply_text = update.message.text
     account_id = context.user_data.get('reply_account_id')
@@ -1269,10 +1497,11 @@ async def manual_reply_process(update: Update, context: ContextTypes.DEFAULT_TYP
         return ConversationHandler.END
 
     account = db.get_account_by_id(account_id)
-    token = await asyncio.to_thread(avito.get_token, account['client_id'], account['client_secret'])
+    token = await avito_client.get_token(account['client_id'], account['client_secret'])
 
     try:
-        await asyncio.to_thread(avito.send_message, token, account['profile_id'], avito_chat_id, reply_text)
+        sent = await avito_client.send_message(token, account['profile_id'], avito_chat_id, reply_text)
+        _store_sent_message(account_id, avito_chat_id, sent, reply_text)
         await update.message.reply_text("✅ Ваш ответ успешно отправлен на Avito.")
         db.log_message(account_id, avito_chat_id, 'out', 'manual', reply_text)
     except Exception as e:
@@ -1370,6 +1599,7 @@ async def show_templates_for_reply(update: Update, context: ContextTypes.DEFAULT
     await query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup(keyboard))
 
 
+@avito_client.with_priority(avito_client.PRIORITY_INTERACTIVE)
 async def send_canned_response(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     try:
@@ -1388,14 +1618,15 @@ async def send_canned_response(update: Update, context: ContextTypes.DEFAULT_TYP
         await query.message.reply_text("❌ Ошибка: не найден аккаунт или шаблон.")
         return
 
-    token = await asyncio.to_thread(avito.get_token, account['client_id'], account['client_secret'])
+    token = await avito_client.get_token(account['client_id'], account['client_secret'])
     if not token:
         await query.message.reply_text("❌ Ошибка авторизации Avito.")
         return
 
     try:
-        await asyncio.to_thread(avito.send_message, token, account['profile_id'], avito_chat_id,
-                                response_template['response_text'])
+        sent = await avito_client.send_message(token, account['profile_id'], avito_chat_id,
+                                               response_template['response_text'])
+        _store_sent_message(account_id, avito_chat_id, sent, response_template['response_text'])
         db.log_message(account_id, avito_chat_id, 'out', 'canned', response_template['response_text'])
         await query.message.reply_text(f"✅ Ответ по шаблону «{response_template['short_name']}» успешно отправлен.")
 
@@ -1543,10 +1774,7 @@ async def templates_category_rename_save(update: Update, context: ContextTypes.D
     new_name = update.message.text.strip()
     category_id = context.user_data['current_category_id']
     try:
-        with sqlite3.connect(db.DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("UPDATE response_categories SET name = ? WHERE id = ?", (new_name, category_id))
-            conn.commit()
+        db.update_category(category_id, new_name)
         await update.message.reply_text("✅ Имя категории обновлено.", reply_markup=ReplyKeyboardRemove())
     except sqlite3.IntegrityError:
         await update.message.reply_text("❌ Категория с таким именем уже существует.",
@@ -1858,34 +2086,37 @@ async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     await query.edit_message_text("⏳ Собираю статистику...")
 
-    all_logs = await asyncio.to_thread(db.get_stats_for_period, period)
-
-    total_in = sum(1 for log in all_logs if log.get('direction') == 'in')
-    total_out = sum(1 for log in all_logs if log.get('direction') == 'out')
+    counts = await asyncio.to_thread(db.get_message_counts, period)
+    total_in = counts['in']
+    total_out = counts['out']
 
     period_map = {'day': 'день', 'week': 'неделю', 'month': 'месяц'}
     text = (f"<b>📊 Статистика за последний {period_map.get(period, '')}</b>\n\n"
             f"📥 Получено сообщений: <b>{total_in}</b>\n"
             f"📤 Отправлено ответов: <b>{total_out}</b>\n\n"
-            f"Подробный отчет можно выгрузить в Excel.")
+            f"Подробный отчет можно выгрузить в файл.")
 
     keyboard = [
-        [InlineKeyboardButton("📤 Выгрузить в .xlsx", callback_data=f"export_excel_{period}")],
-        [InlineKeyboardButton("⬅️ Назад", callback_data="stats_menu")]
+        [InlineKeyboardButton("📤 Выгрузить в .xlsx", callback_data=f"export_xlsx_{period}")],
+        [InlineKeyboardButton("📤 .csv", callback_data=f"export_csv_{period}"),
+         InlineKeyboardButton("📤 .csv.gz", callback_data=f"export_csvgz_{period}")],
     ]
+    if 'parquet' in stats_export.available_formats():
+        keyboard.append([InlineKeyboardButton("📤 .parquet", callback_data=f"export_parquet_{period}")])
+    keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="stats_menu")])
 
     await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.HTML)
     return SHOW_STATS
 
 
-async def export_stats_to_excel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def export_stats_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    period = query.data.split('_')[-1]
+    _, fmt, period = query.data.split('_')
     chat_id = query.message.chat_id
 
-    all_logs = db.get_stats_for_period(period)
+    has_logs = await asyncio.to_thread(db.has_stats_for_period, period)
 
-    if not all_logs:
+    if not has_logs:
         try:
             await query.answer("❌ Нет данных для экспорта за выбранный период.", show_alert=True)
         except BadRequest:
@@ -1894,7 +2125,7 @@ async def export_stats_to_excel(update: Update, context: ContextTypes.DEFAULT_TY
         return SHOW_STATS
 
     try:
-        await query.answer("⏳ Готовлю Excel-файл...")
+        await query.answer("⏳ Готовлю файл...")
     except BadRequest:
         pass
 
@@ -1903,26 +2134,23 @@ async def export_stats_to_excel(update: Update, context: ContextTypes.DEFAULT_TY
     except BadRequest as e:
         logger.warning(f"Не удалось удалить сообщение с меню статистики: {e}")
 
-    df = pd.DataFrame(all_logs)
-    df['timestamp'] = pd.to_datetime(df['timestamp']).dt.tz_convert('Europe/Moscow').dt.strftime('%d.%m.%Y %H:%M:%S')
-    df = df[['timestamp', 'account_name', 'direction', 'reply_type', 'message_text']]
-    df.columns = ['Дата (МСК)', 'Аккаунт Avito', 'Направление', 'Тип ответа', 'Текст сообщения']
-
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Статистика')
-        worksheet = writer.sheets['Статистика']
-        for i, col in enumerate(df.columns):
-            column_len = max(df[col].astype(str).map(len).max(), len(col)) + 3
-            worksheet.column_dimensions[get_column_letter(i + 1)].width = column_len
-    output.seek(0)
-
-    file_name = f"avito_stats_{period}_{datetime.now().strftime('%Y-%m-%d')}.xlsx"
-
-    await context.bot.send_document(
-        chat_id=chat_id, document=output, filename=file_name,
-        caption=f"📊 Ваш отчет по статистике готов."
-    )
+    # Файл собирается в рабочем потоке, чтобы большая выгрузка не блокировала бота.
+    output, size = await asyncio.to_thread(stats_export.export_stats_for_period, fmt, period)
+
+    file_name = f"avito_stats_{period}_{datetime.now().strftime('%Y-%m-%d')}.{stats_export.EXPORT_FORMATS[fmt]}"
+
+    with output:
+        if size > TELEGRAM_DOCUMENT_LIMIT:
+            await context.bot.send_message(
+                chat_id=chat_id,
+                text=f"❌ Файл получился слишком большим для Telegram ({size // (1024 * 1024)} МБ). "
+                     f"Выберите .csv.gz или .parquet либо выгрузите данные скриптом stats_export.py."
+            )
+        else:
+            await context.bot.send_document(
+                chat_id=chat_id, document=output, filename=file_name,
+                caption=f"📊 Ваш отчет по статистике готов."
+            )
 
     keyboard = [
         [InlineKeyboardButton("📊 За день", callback_data="stats_show_day")],
@@ -1989,13 +2217,14 @@ async def search_select_account(update: Update, context: ContextTypes.DEFAULT_TY
     return SEARCH_AWAIT_QUERY
 
 
+@avito_client.with_priority(avito_client.PRIORITY_BACKGROUND)
 async def search_process_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query_text = update.message.text.lower()
+    query_text = db.normalize_search_text(update.message.text)
     account_id = context.user_data['search_account_id']
     await update.message.reply_text("⏳ Выполняю поиск (это может занять время)...", reply_markup=ReplyKeyboardRemove())
 
     account = db.get_account_by_id(account_id)
-    token = await asyncio.to_thread(avito.get_token, account['client_id'], account['client_secret'])
+    token = await avito_client.get_token(account['client_id'], account['client_secret'])
 
     if not token:
         await update.message.reply_text("❌ Ошибка авторизации Avito. Не удалось выполнить поиск.")
@@ -2004,59 +2233,41 @@ async def search_process_query(update: Update, context: ContextTypes.DEFAULT_TYP
     active_period_days = int(context.bot_data['config']['SETTINGS'].get('ACTIVE_PERIOD_DAYS', 30))
     archive_boundary_ts = int(time.time()) - (active_period_days * 24 * 60 * 60)
 
-    recent_chats = []
-    offset = 0
-    limit = 50
-    stop_fetching = False
+    recent_chats = await chat_sync.synchronizer.sync(token, account, archive_boundary_ts) or []
 
-    while not stop_fetching:
-        try:
-            chats_batch = await asyncio.to_thread(avito.get_chats, token, account['profile_id'], limit, offset)
-            if not chats_batch:
-                break
-
-            for chat in chats_batch:
-                last_message_ts = chat.get('last_message', {}).get('created', 0)
-                if last_message_ts < archive_boundary_ts:
-                    stop_fetching = True
-                    break
-                recent_chats.append(chat)
-
-            if len(chats_batch) < limit:
-                break
-            offset += limit
-        except Exception as e:
-            logger.error(f"Ошибка получения списка чатов для поиска: {e}")
-            break
-
-    found_chats = []
     found_chat_ids = set()
-
     for chat in recent_chats:
-        if chat['id'] in found_chat_ids:
-            continue
-
-        context_title = chat.get('context', {}).get('value', {}).get('title', '').lower()
-        last_message_text = chat.get('last_message', {}).get('content', {}).get('text', '').lower()
-        user_name = chat.get('users', [{}])[0].get('name', '').lower()
+        context_title = db.normalize_search_text(chat.get('context', {}).get('value', {}).get('title', ''))
+        last_message_text = db.normalize_search_text(chat.get('last_message', {}).get('content', {}).get('text', ''))
+        user_name = db.normalize_search_text(chat.get('users', [{}])[0].get('name', ''))
 
         if query_text in context_title or query_text in last_message_text or query_text in user_name:
-            found_chats.append(chat)
             found_chat_ids.add(chat['id'])
-            continue
 
-        try:
-            await asyncio.sleep(0.1)
-            messages = await asyncio.to_thread(avito.get_messages, token, account['profile_id'], chat['id'])
-            for message in messages:
-                message_text = message.get('content', {}).get('text', '').lower()
-                if query_text in message_text:
-                    found_chats.append(chat)
-                    found_chat_ids.add(chat['id'])
-                    break
-        except Exception as e:
-            logger.warning(f"Не удалось выполнить глубокий поиск для чата {chat['id']}: {e}")
-            continue
+    # Переписка ищется по локальному индексу; к API обращаемся только за чатами, которые еще не загружались.
+    found_chat_ids.update(await asyncio.to_thread(db.search_message_chats, account_id, query_text))
+    synced_chat_ids = await asyncio.to_thread(db.get_synced_chat_ids, account_id, [chat['id'] for chat in recent_chats])
+    unsynced_chats = [chat for chat in recent_chats
+                      if chat['id'] not in found_chat_ids and chat['id'] not in synced_chat_ids]
+
+    if unsynced_chats:
+        logger.info(f"Поиск: загружаю сообщения {len(unsynced_chats)} чатов, которых еще нет в индексе.")
+        settings = context.bot_data['config']['SETTINGS']
+        fetched_chats = await _fetch_chats_messages(
+            token, account['profile_id'], unsynced_chats,
+            max_in_flight=int(settings.get('CHAT_FETCH_CONCURRENCY', 5)),
+            rate_limiter=AsyncRateLimiter(float(settings.get('CHAT_FETCH_RATE', 10)))
+        )
+        for chat, messages in zip(unsynced_chats, fetched_chats):
+            if isinstance(messages, BaseException) or messages is None:
+                logger.warning(f"Не удалось выполнить глубокий поиск для чата {chat['id']}: {messages}")
+                continue
+            db.store_messages(account_id, chat['id'], messages, mark_synced=True)
+            if any(query_text in db.normalize_search_text(message.get('content', {}).get('text', ''))
+                   for message in messages):
+                found_chat_ids.add(chat['id'])
+
+    found_chats = [chat for chat in recent_chats if chat['id'] in found_chat_ids]
 
     context.user_data['search_results'] = found_chats
     context.user_data['search_account'] = account
@@ -2589,6 +2800,7 @@ async def set_provider_for_account(update: Update, context: ContextTypes.DEFAULT
     return AUTOMATION_SETTINGS_MENU
 
 
+@avito_client.with_priority(avito_client.PRIORITY_INTERACTIVE)
 async def ai_reply_process(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     try:
@@ -2612,34 +2824,77 @@ async def ai_reply_process(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"❌ API ключ для {account['ai_provider']} не найден. Укажите его в Настройках AI.")
         return
 
-    token = await asyncio.to_thread(avito.get_token, account['client_id'], account['client_secret'])
+    token = await avito_client.get_token(account['client_id'], account['client_secret'])
     if not token:
         await query.message.reply_text("❌ Ошибка авторизации Avito.")
         return
 
-    history = await asyncio.to_thread(avito.get_chat_history, token, account['profile_id'], chat_id_avito)
+    history = await avito_client.get_chat_history(token, account['profile_id'], chat_id_avito)
 
     prompt_text = account.get('prompt_text_full') or DEFAULT_PROMPT
 
-    ai_response = await avito.generate_ai_reply(history, api_key, account['ai_provider'], prompt_text)
+    preview_message = None
+    if context.bot_data['config']['SETTINGS'].get('AI_STREAM_PREVIEW', 'true').lower() == 'true':
+        preview_interval = float(context.bot_data['config']['SETTINGS'].get('AI_PREVIEW_EDIT_INTERVAL', 1.5))
+        preview_message, ai_response = await _stream_ai_reply_with_preview(
+            query.message, ai_client.stream_reply(history, api_key, account['ai_provider'], prompt_text),
+            preview_interval)
+    else:
+        ai_response = await ai_client.generate_reply(history, api_key, account['ai_provider'], prompt_text)
+
+    async def report(text):
+        if preview_message:
+            try:
+                await preview_message.edit_text(text, parse_mode=ParseMode.HTML)
+                return
+            except BadRequest:
+                pass
+        await query.message.reply_text(text, parse_mode=ParseMode.HTML)
 
     if not ai_response or not ai_response.strip():
-        await query.message.reply_text("❌ Не удалось сгенерировать ответ. ИИ вернул пустой результат.")
+        await report("❌ Не удалось сгенерировать ответ. ИИ вернул пустой результат.")
         return
 
     try:
-        await asyncio.to_thread(avito.send_message, token, account['profile_id'], chat_id_avito, ai_response)
+        sent = await avito_client.send_message(token, account['profile_id'], chat_id_avito, ai_response)
+        _store_sent_message(account_id, chat_id_avito, sent, ai_response)
 
-        await query.message.reply_text(
-            f"✅ AI-ответ успешно отправлен:\n\n<i>{html.escape(ai_response)}</i>",
-            parse_mode=ParseMode.HTML
-        )
+        await report(f"✅ AI-ответ успешно отправлен:\n\n<i>{html.escape(ai_response)}</i>")
 
         db.log_message(account_id, chat_id_avito, 'out', 'ai_manual', ai_response)
     except Exception as e:
-        await query.message.reply_text(f"❌ Не удалось отправить AI-ответ: {e}")
+        await report(f"❌ Не удалось отправить AI-ответ: {html.escape(str(e))}")
         logger.error(f"Ошибка отправки AI ответа: {e}")
 
+
+async def _stream_ai_reply_with_preview(message, chunks, edit_interval):
+    # Черновик обновляется не чаще edit_interval секунд, чтобы не упереться в лимит редактирований Telegram.
+    preview_message = await message.reply_text("🤖 Генерирую ответ...")
+    parts = []
+    shown_text = ''
+    next_edit_at = time.monotonic() + edit_interval
+    try:
+        async for chunk in chunks:
+            parts.append(chunk)
+            preview_text = ''.join(parts)
+            if time.monotonic() < next_edit_at or not preview_text.strip() or preview_text == shown_text:
+                continue
+            next_edit_at = time.monotonic() + edit_interval
+            try:
+                await preview_message.edit_text(f"🤖 Черновик ответа:\n\n{preview_text[:TELEGRAM_PREVIEW_LIMIT]} ▌")
+                shown_text = preview_text
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                logger.info(f"Telegram ограничил редактирование черновика на {retry_after} сек.")
+                next_edit_at = time.monotonic() + retry_after
+            except BadRequest:
+                pass
+    except Exception as e:
+        logger.error(f"Ошибка потоковой генерации AI-ответа: {e}")
+        return preview_message, None
+    return preview_message, ''.join(parts)
+
+
 async def delete_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     try:
@@ -2685,13 +2940,32 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 def main():
     db.init_database()
+    db.import_last_timestamps_json(LAST_TIMESTAMPS_FILE)
     config = configparser.ConfigParser()
     if not os.path.exists(CONFIG_FILE):
         logger.critical(f"Файл конфигурации {CONFIG_FILE} не найден!")
         return
     config.read(CONFIG_FILE, encoding='utf-8')
 
-    application = Application.builder().token(config['TELEGRAM']['BOT_TOKEN']).build()
+    avito_client.configure(pool_limit=int(config['SETTINGS'].get('HTTP_POOL_MAXSIZE', 100)),
+                           max_concurrency=int(config['SETTINGS'].get('AVITO_MAX_CONCURRENCY', 16)))
+    avito.rate_governor.configure(client_rate=float(config['SETTINGS'].get('AVITO_RATE_PER_CLIENT', 10)))
+    ai_client.configure(request_timeout=config['SETTINGS'].get('AI_REQUEST_TIMEOUT', 60),
+                        max_connections=config['SETTINGS'].get('AI_MAX_CONNECTIONS', 50),
+                        max_retries=config['SETTINGS'].get('AI_MAX_RETRIES', 3))
+    ai_client.limiter.configure(provider_concurrency=config['SETTINGS'].get('AI_MAX_CONCURRENCY_PER_PROVIDER', 8),
+                                key_concurrency=config['SETTINGS'].get('AI_MAX_CONCURRENCY_PER_KEY', 4),
+                                tokens_per_minute=config['SETTINGS'].get('AI_TOKENS_PER_MINUTE', 0))
+    reply_cache = ai_cache.reply_cache
+    reply_cache.ttl = int(config['SETTINGS'].get('AI_CACHE_TTL', 7 * 24 * 3600))
+    reply_cache.max_entries = int(config['SETTINGS'].get('AI_CACHE_MAX_ENTRIES', 5000))
+    reply_cache.fuzzy_threshold = float(config['SETTINGS'].get('AI_CACHE_FUZZY_THRESHOLD', 0))
+    db.start_stats_writer(batch_size=config['SETTINGS'].get('STATS_BATCH_SIZE', 200),
+                          flush_interval=config['SETTINGS'].get('STATS_FLUSH_INTERVAL', 1.0))
+
+    webhook_enabled = is_webhook_enabled(config)
+    application = (Application.builder().token(config['TELEGRAM']['BOT_TOKEN'])
+                   .post_init(post_init).post_shutdown(post_shutdown).build())
     application.bot_data['config'] = config
 
     unified_conv_handler = ConversationHandler(
@@ -2799,7 +3073,7 @@ def main():
                 CallbackQueryHandler(start, pattern='^main_menu$'),
             ],
             SHOW_STATS: [
-                CallbackQueryHandler(export_stats_to_excel, pattern=r'^export_excel_'),
+                CallbackQueryHandler(export_stats_file, pattern=r'^export_(xlsx|csv|csvgz|parquet)_'),
                 CallbackQueryHandler(stats_menu, pattern='^stats_menu$'),
             ],
             AI_MENU: [
@@ -2886,7 +3160,13 @@ def main():
 
     check_interval_str = config['SETTINGS'].get('CHECK_INTERVAL', '300')
     check_interval = int(check_interval_str) if check_interval_str.isdigit() else 300
+    if webhook_enabled:
+        # При работе через вебхуки опрос остается редкой сверкой на случай пропущенных событий.
+        check_interval = max(check_interval, int(config['WEBHOOK'].get('RECONCILE_INTERVAL', 600)))
     application.job_queue.run_repeating(check_avito_messages, interval=check_interval, first=5)
+    backfill_interval = int(config['SETTINGS'].get('BACKFILL_INTERVAL', 300))
+    if backfill_interval > 0:
+        application.job_queue.run_repeating(history_backfill_job, interval=backfill_interval, first=60)
 
     logger.info("Бот запущен...")
     application.run_polling()
@@ -0,0 +1,350 @@
+import asyncio
+import contextvars
+import functools
+import itertools
+import logging
+import time
+
+import aiohttp
+
+import avito_api
+from avito_api import API_BASE_URL
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 15
+DEFAULT_POOL_SIZE = 10
+_session = None
+_session_loop = None
+_pool_size = DEFAULT_POOL_SIZE
+_retired_sessions = set()
+_pool_limit = 100
+_in_flight = 0
+_requests_sent = 0
+_token_refresh_tasks = {}
+REQUEST_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, avito_api.AvitoAPIError)
+
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_AUTO_REPLY = 1
+PRIORITY_POLLING = 2
+PRIORITY_BACKGROUND = 3
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: 'interactive',
+    PRIORITY_AUTO_REPLY: 'auto_reply',
+    PRIORITY_POLLING: 'polling',
+    PRIORITY_BACKGROUND: 'background',
+}
+_current_priority = contextvars.ContextVar('avito_request_priority', default=PRIORITY_POLLING)
+
+
+def current_priority():
+    return _current_priority.get()
+
+
+def with_priority(level):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            reset_token = _current_priority.set(level)
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                _current_priority.reset(reset_token)
+        return wrapper
+    return decorator
+
+
+class RequestScheduler:
+    def __init__(self, max_concurrency=16):
+        self.configure(max_concurrency)
+        self._active = {level: 0 for level in PRIORITY_NAMES}
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._stats = {level: {'completed': 0, 'max_queue_depth': 0, 'wait_time_total': 0.0}
+                       for level in PRIORITY_NAMES}
+
+    def configure(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        # Фоновые классы ограничены сильнее, чтобы для интерактивных запросов всегда оставались слоты.
+        self.class_limits = {
+            PRIORITY_INTERACTIVE: max_concurrency,
+            PRIORITY_AUTO_REPLY: max(1, max_concurrency // 4),
+            PRIORITY_POLLING: max(1, max_concurrency // 2),
+            PRIORITY_BACKGROUND: max(1, max_concurrency // 8),
+        }
+
+    def _can_run(self, level):
+        return (sum(self._active.values()) < self.max_concurrency
+                and self._active[level] < self.class_limits[level])
+
+    def _queue_depth(self, level):
+        return sum(1 for waiter_level, _, _ in self._waiters if waiter_level == level)
+
+    async def acquire(self, level):
+        started_at = time.monotonic()
+        has_priority_waiters = any(waiter_level <= level for waiter_level, _, _ in self._waiters)
+        if not has_priority_waiters and self._can_run(level):
+            self._active[level] += 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        waiter = (level, next(self._sequence), future)
+        self._waiters.append(waiter)
+        stats = self._stats[level]
+        stats['max_queue_depth'] = max(stats['max_queue_depth'], self._queue_depth(level))
+        try:
+            await future
+        except asyncio.CancelledError:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            elif future.done() and not future.cancelled():
+                self.release(level)
+            raise
+        stats['wait_time_total'] += time.monotonic() - started_at
+
+    def release(self, level):
+        self._active[level] -= 1
+        self._stats[level]['completed'] += 1
+        self._wake_waiters()
+
+    def _wake_waiters(self):
+        for waiter in sorted(self._waiters):
+            level, _, future = waiter
+            if not self._can_run(level):
+                continue
+            self._waiters.remove(waiter)
+            if future.done():
+                continue
+            self._active[level] += 1
+            future.set_result(None)
+
+    def load_above(self, level):
+        # Сколько запросов более приоритетных классов сейчас выполняется или ждет слота.
+        return sum(self._active[other] + self._queue_depth(other) for other in PRIORITY_NAMES if other < level)
+
+    def get_stats(self):
+        stats = {}
+        for level, name in PRIORITY_NAMES.items():
+            class_stats = self._stats[level]
+            completed = class_stats['completed'] or 1
+            stats[name] = {
+                'active': self._active[level],
+                'queued': self._queue_depth(level),
+                'max_queue_depth': class_stats['max_queue_depth'],
+                'completed': class_stats['completed'],
+                'avg_wait_ms': round(class_stats['wait_time_total'] / completed * 1000, 1),
+            }
+        return stats
+
+
+scheduler = RequestScheduler()
+
+
+def configure(pool_limit=None, max_concurrency=None):
+    global _pool_limit
+    if pool_limit is not None:
+        _pool_limit = max(1, int(pool_limit))
+    if max_concurrency is not None:
+        scheduler.configure(max(1, int(max_concurrency)))
+
+
+def size_pool_for_accounts(accounts_count, per_account):
+    # Пул рассчитан на одновременный опрос аккаунтов с их параллельной загрузкой чатов, но не больше HTTP_POOL_MAXSIZE.
+    global _pool_size, _session
+    new_size = min(_pool_limit, max(DEFAULT_POOL_SIZE, accounts_count * per_account))
+    if new_size == _pool_size:
+        return
+    _pool_size = new_size
+    logger.info(f"Размер пула HTTP-соединений Avito изменен на {_pool_size}")
+    if _session is not None and not _session.closed:
+        # Лимит коннектора не меняется на ходу: новые запросы идут через новую сессию,
+        # старая закрывается, когда ее запросы гарантированно завершились по таймауту.
+        old_session, _session = _session, None
+        _retired_sessions.add(old_session)
+        asyncio.get_running_loop().call_later(DEFAULT_TIMEOUT + 1,
+                                              lambda: asyncio.ensure_future(_close_retired(old_session)))
+
+
+async def _close_retired(session):
+    _retired_sessions.discard(session)
+    await session.close()
+
+
+def _get_session():
+    global _session, _session_loop
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        connector = aiohttp.TCPConnector(limit=_pool_size, ttl_dns_cache=300)
+        _session = aiohttp.ClientSession(connector=connector,
+                                         timeout=aiohttp.ClientTimeout(total=DEFAULT_TIMEOUT))
+        _session_loop = loop
+    return _session
+
+
+async def close():
+    global _session, _session_loop
+    for session in list(_retired_sessions):
+        await _close_retired(session)
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+    _session_loop = None
+
+
+def get_pool_stats():
+    stats = {'pool_size': _pool_size, 'pool_limit': _pool_limit, 'in_flight': _in_flight,
+             'requests_sent': _requests_sent, 'connections_in_use': 0, 'idle_connections': 0}
+    if _session is not None and not _session.closed:
+        # Публичного API для состояния пула у aiohttp нет, поэтому читаем внутренние поля коннектора.
+        connector = _session.connector
+        stats['connections_in_use'] = len(getattr(connector, '_acquired', ()))
+        stats['idle_connections'] = sum(len(conns) for conns in getattr(connector, '_conns', {}).values())
+    stats['scheduler'] = scheduler.get_stats()
+    return stats
+
+
+async def _request(method, url, endpoint, token=None, client_id=None, retry_on_error=True, **kwargs):
+    client_id = client_id or avito_api.client_id_for_token(token) or 'anonymous'
+    if token:
+        kwargs.setdefault('headers', {})['Authorization'] = f'Bearer {token}'
+
+    governor = avito_api.rate_governor
+    level = current_priority()
+    interactive = level == PRIORITY_INTERACTIVE
+    for attempt in range(avito_api.MAX_RETRIES + 1):
+        # Ручные запросы берут токен сразу; остальные ждут свободного токена сверх запаса для ручных,
+        # поэтому очередь опроса не задерживает ответ менеджера.
+        while True:
+            wait = governor.reserve(client_id, endpoint, interactive)
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+            if interactive:
+                break
+        await scheduler.acquire(level)
+        try:
+            data = await _send(method, url, client_id, endpoint, **kwargs)
+            governor.on_success(client_id, endpoint)
+            return data
+        except avito_api.AvitoRateLimitError as e:
+            if attempt == avito_api.MAX_RETRIES:
+                raise
+            delay = governor.backoff_delay(attempt, e.retry_after)
+        except (avito_api.AvitoAPIError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if isinstance(e, avito_api.AvitoAuthError) or not retry_on_error or attempt == avito_api.MAX_RETRIES:
+                raise
+            delay = governor.backoff_delay(attempt)
+        finally:
+            scheduler.release(level)
+        logger.warning(f"Повтор запроса к Avito ({endpoint}) через {delay:.1f} сек.")
+        await asyncio.sleep(delay)
+
+
+async def _send(method, url, client_id, endpoint, **kwargs):
+    global _in_flight, _requests_sent
+    _in_flight += 1
+    try:
+        async with _get_session().request(method, url, **kwargs) as response:
+            avito_api.check_response_status(response.status, response.headers, client_id, endpoint)
+            response.raise_for_status()
+            return await response.json(content_type=None)
+    finally:
+        _in_flight -= 1
+        _requests_sent += 1
+
+
+async def clear_token(client_id: str):
+    avito_api.clear_token(client_id, persist=False)
+    await asyncio.to_thread(avito_api.persist_token_cache)
+
+
+async def get_token(client_id, client_secret):
+    cached_token = avito_api.get_cached_token(client_id)
+    if cached_token and not avito_api.token_needs_refresh(client_id):
+        return cached_token
+
+    task = _token_refresh_tasks.get(client_id)
+    if task is None:
+        task = asyncio.create_task(_refresh_token(client_id, client_secret))
+        _token_refresh_tasks[client_id] = task
+        task.add_done_callback(lambda _: _token_refresh_tasks.pop(client_id, None))
+
+    if cached_token:
+        # Токен еще действует: обновляем его в фоне, не задерживая вызывающего.
+        return cached_token
+    return await asyncio.shield(task)
+
+
+async def _refresh_token(client_id, client_secret):
+    logger.info(f"Запрашивается новый токен для ID {client_id}")
+    try:
+        token_data = await _request('POST', f"{API_BASE_URL}/token/", 'token', client_id=client_id,
+                                    data=avito_api.token_request_data(client_id, client_secret),
+                                    timeout=aiohttp.ClientTimeout(total=10))
+    except REQUEST_ERRORS as e:
+        logger.error(f"Ошибка токена Avito для ID {client_id}: {e}")
+        return avito_api.get_cached_token(client_id)
+
+    access_token = avito_api.store_token(client_id, token_data, persist=False)
+    await asyncio.to_thread(avito_api.persist_token_cache)
+    return access_token
+
+
+async def get_chats(token, profile_id, limit=100, offset=0, unread_only=False):
+    params = {'limit': limit, 'offset': offset}
+    if unread_only:
+        params['unread_only'] = 'true'
+    try:
+        data = await _request('GET', f"{API_BASE_URL}/messenger/v2/accounts/{profile_id}/chats", 'chats', token,
+                              params=params)
+        return data.get('chats', [])
+    except REQUEST_ERRORS as e:
+        logger.error(f"Ошибка при получении чатов для {profile_id}: {e}")
+        return None
+
+
+async def get_chat(token, profile_id, chat_id):
+    try:
+        return await _request('GET', f"{API_BASE_URL}/messenger/v2/accounts/{profile_id}/chats/{chat_id}",
+                              'chat', token)
+    except REQUEST_ERRORS as e:
+        logger.error(f"Ошибка при получении чата {chat_id}: {e}")
+        return None
+
+
+async def get_messages(token, profile_id, chat_id, limit=None, offset=None):
+    params = {}
+    if limit is not None:
+        params['limit'] = limit
+    if offset is not None:
+        params['offset'] = offset
+    try:
+        data = await _request('GET', f"{API_BASE_URL}/messenger/v3/accounts/{profile_id}/chats/{chat_id}/messages",
+                              'messages', token, params=params)
+        return data.get('messages', [])
+    except REQUEST_ERRORS as e:
+        logger.error(f"Ошибка при получении сообщений для чата {chat_id}: {e}")
+        return None
+
+
+async def send_message(token, profile_id, chat_id, message_text):
+    try:
+        # Повторяем только отказы по лимиту: при ошибке сервера сообщение могло уйти.
+        return await _request('POST', f"{API_BASE_URL}/messenger/v1/accounts/{profile_id}/chats/{chat_id}/messages",
+                              'send', token, retry_on_error=False,
+                              json=avito_api.send_message_payload(chat_id, message_text))
+    except REQUEST_ERRORS as e:
+        logger.error(f"Ошибка при отправке сообщения в чат {chat_id}: {e}")
+        raise e
+
+
+async def get_chat_history(token, profile_id, chat_id, limit=avito_api.CHAT_HISTORY_LIMIT):
+    return avito_api.format_chat_history(await get_messages(token, profile_id, chat_id), limit)
+
+
+async def subscribe_webhook(token, profile_id, webhook_url):
+    data = await _request('POST', f"{API_BASE_URL}/messenger/v3/webhook", 'webhook', token,
+                          json={"url": webhook_url, "user_id": profile_id})
+    logger.info(f"Аккаунт {profile_id} успешно подписан на вебхук: {webhook_url}")
+    return data
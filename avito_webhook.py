@@ -0,0 +1,126 @@
+import argparse
+import asyncio
+import hmac
+import logging
+import time
+import uuid
+
+from aiohttp import web, ClientSession
+
+import database as db
+
+logger = logging.getLogger(__name__)
+
+
+def parse_message_event(event):
+    payload = event.get('payload')
+    if not isinstance(payload, dict) or payload.get('type') != 'message':
+        return None
+
+    value = payload.get('value')
+    if not isinstance(value, dict) or not value.get('chat_id') or value.get('user_id') is None:
+        return None
+
+    direction = 'out' if str(value.get('author_id')) == str(value.get('user_id')) else 'in'
+    return {
+        'profile_id': str(value['user_id']),
+        'chat_id': value['chat_id'],
+        'message': {
+            'id': value.get('id'),
+            'created': value.get('created', int(time.time())),
+            'type': value.get('type', 'text'),
+            'direction': direction,
+            'author_id': value.get('author_id'),
+            'content': value.get('content') or {},
+        }
+    }
+
+
+def create_webhook_app(path, secret, on_message):
+    pending_tasks = set()
+
+    async def handle_event(request):
+        # Avito не подписывает события, поэтому адрес подписки содержит секрет в параметре token.
+        if not hmac.compare_digest(request.query.get('token', '').encode(), secret.encode()):
+            return web.Response(status=403, text='forbidden')
+
+        try:
+            event = await request.json()
+        except ValueError:
+            return web.Response(status=400, text='invalid json')
+        if not isinstance(event, dict):
+            return web.Response(status=400, text='invalid event')
+
+        parsed = parse_message_event(event)
+        if not parsed:
+            return web.Response(text='ignored')
+
+        account = db.get_account_by_profile_id(parsed['profile_id'])
+        if not account:
+            logger.warning(f"Вебхук: не найден аккаунт для профиля {parsed['profile_id']}")
+            return web.Response(text='unknown account')
+
+        # Avito ожидает быстрый ответ, поэтому событие обрабатывается в фоне.
+        task = asyncio.create_task(on_message(account, parsed['chat_id'], parsed['message']))
+        pending_tasks.add(task)
+        task.add_done_callback(pending_tasks.discard)
+        return web.Response(text='ok')
+
+    app = web.Application()
+    app.router.add_post(path, handle_event)
+    return app
+
+
+async def start_webhook_server(host, port, path, secret, on_message):
+    runner = web.AppRunner(create_webhook_app(path, secret, on_message))
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    logger.info(f"Сервер вебхуков запущен на {host}:{port}{path}")
+    return runner
+
+
+async def stop_webhook_server(runner):
+    await runner.cleanup()
+    logger.info("Сервер вебхуков остановлен.")
+
+
+def build_fake_event(profile_id, chat_id, text, author_id=None):
+    return {
+        'id': str(uuid.uuid4()),
+        'version': 'v3.0.0',
+        'timestamp': int(time.time()),
+        'payload': {
+            'type': 'message',
+            'value': {
+                'id': str(uuid.uuid4()),
+                'chat_id': chat_id,
+                'user_id': int(profile_id),
+                'author_id': int(author_id) if author_id else 0,
+                'created': int(time.time()),
+                'type': 'text',
+                'chat_type': 'u2i',
+                'content': {'text': text},
+            }
+        }
+    }
+
+
+async def send_fake_event(url, secret, profile_id, chat_id, text, author_id=None):
+    async with ClientSession() as session:
+        async with session.post(url, params={'token': secret},
+                                json=build_fake_event(profile_id, chat_id, text, author_id)) as response:
+            return response.status, await response.text()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Отправка тестового события Avito на локальный вебхук.")
+    parser.add_argument('--url', default='http://127.0.0.1:8080/avito/webhook')
+    parser.add_argument('--secret', required=True, help="Значение SECRET из секции [WEBHOOK]")
+    parser.add_argument('--profile-id', required=True)
+    parser.add_argument('--chat-id', required=True)
+    parser.add_argument('--text', default='Здравствуйте! Актуально?')
+    args = parser.parse_args()
+
+    status, body = asyncio.run(send_fake_event(args.url, args.secret, args.profile_id, args.chat_id, args.text))
+    print(f"{status}: {body}")
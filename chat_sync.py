@@ -0,0 +1,83 @@
+import asyncio
+import logging
+
+import avito_client
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 50
+
+
+class ChatListSynchronizer:
+    def __init__(self):
+        self._chats = {}
+        self._high_water_marks = {}
+        self._locks = {}
+
+    def forget(self, account_id):
+        # Вызывается при удалении, отключении аккаунта и смене его учетных данных.
+        self._chats.pop(account_id, None)
+        self._high_water_marks.pop(account_id, None)
+
+    async def sync(self, token, account, archive_boundary_ts):
+        account_id = account['id']
+        lock = self._locks.setdefault(account_id, asyncio.Lock())
+        async with lock:
+            changed_chats = await self._fetch_changed(token, account, archive_boundary_ts)
+            if changed_chats is None:
+                return None
+
+            chats = self._chats.setdefault(account_id, {})
+            for chat in changed_chats:
+                chats[chat['id']] = chat
+            for chat_id in [chat_id for chat_id, chat in chats.items()
+                            if _last_message_ts(chat) < archive_boundary_ts]:
+                del chats[chat_id]
+
+            if changed_chats:
+                self._high_water_marks[account_id] = max(
+                    self._high_water_marks.get(account_id, 0), max(_last_message_ts(c) for c in changed_chats))
+            return sorted(chats.values(), key=_last_message_ts, reverse=True)
+
+    async def _fetch_changed(self, token, account, archive_boundary_ts):
+        high_water_mark = self._high_water_marks.get(account['id'])
+        changed_chats = []
+        offset = 0
+        pages = 0
+
+        while True:
+            chats_batch = await avito_client.get_chats(token, account['profile_id'], PAGE_SIZE, offset)
+            pages += 1
+            if chats_batch is None:
+                # Отметку не сдвигаем: иначе пропущенные страницы посчитались бы неизменными.
+                logger.warning(f"Ошибка API при получении чатов для '{account['name']}'.")
+                return None
+            if not chats_batch:
+                break
+
+            reached_known = False
+            for chat in chats_batch:
+                last_message_ts = _last_message_ts(chat)
+                if last_message_ts < archive_boundary_ts:
+                    reached_known = True
+                    break
+                # Чаты отсортированы по последнему сообщению: все, что старше отметки, не менялось.
+                if high_water_mark is not None and last_message_ts < high_water_mark:
+                    reached_known = True
+                    break
+                changed_chats.append(chat)
+
+            if reached_known or len(chats_batch) < PAGE_SIZE:
+                break
+            offset += PAGE_SIZE
+
+        logger.info(f"Аккаунт '{account['name']}': синхронизация списка чатов, страниц: {pages}, "
+                    f"изменившихся чатов: {len(changed_chats)}.")
+        return changed_chats
+
+
+def _last_message_ts(chat):
+    return chat.get('last_message', {}).get('created', 0)
+
+
+synchronizer = ChatListSynchronizer()
@@ -1,15 +1,66 @@
 import sqlite3
 import logging
-from datetime import datetime, timezone
+import json
+import atexit
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
 
 DB_FILE = 'avito_manager.sqlite'
 logger = logging.getLogger(__name__)
 
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA foreign_keys = ON",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 134217728",
+    "PRAGMA temp_store = MEMORY",
+)
+_local = threading.local()
+
+
+def get_connection():
+    # Одно долгоживущее соединение на поток: sqlite3 не разрешает делить соединение между потоками.
+    conn = getattr(_local, 'conn', None)
+    if conn is None or getattr(_local, 'db_file', None) != DB_FILE:
+        conn = sqlite3.connect(DB_FILE, timeout=30, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.create_function('search_fold', 1, normalize_search_text, deterministic=True)
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        _local.conn = conn
+        _local.db_file = DB_FILE
+    return conn
+
+
+def close_connection():
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        conn.close()
+        _local.conn = None
+
+
+_settings_version = 0
+
+
+def get_settings_version():
+    return _settings_version
+
+
+def _bump_settings_version():
+    # Сбрасывает кэши, построенные по аккаунтам и шаблонам (например, главное меню).
+    global _settings_version
+    _settings_version += 1
+
 
 def init_database():
-    with sqlite3.connect(DB_FILE) as conn:
+    with get_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("PRAGMA foreign_keys = ON;")
         cursor.execute('''
                     CREATE TABLE IF NOT EXISTS accounts (
                         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -59,6 +110,20 @@ def init_database():
                 FOREIGN KEY (account_id) REFERENCES accounts (id) ON DELETE CASCADE
             )
         ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chat_state (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                account_id INTEGER NOT NULL,
+                chat_id TEXT NOT NULL,
+                last_message_ts INTEGER NOT NULL DEFAULT 0,
+                last_direction TEXT,
+                is_unread BOOLEAN NOT NULL DEFAULT 0,
+                updated_at TEXT NOT NULL,
+                FOREIGN KEY (account_id) REFERENCES accounts (id) ON DELETE CASCADE
+            )
+        ''')
+        cursor.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_chat_state_account_chat ON chat_state (account_id, chat_id)")
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS prompts (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -67,22 +132,226 @@ def init_database():
             )
         ''')
         conn.commit()
+        _apply_migrations(conn)
         logger.info("База данных успешно инициализирована.")
+    check_query_plans()
+
+
+# Миграции применяются по порядку, номер последней примененной хранится в PRAGMA user_version.
+MIGRATIONS = (
+    (
+        "CREATE INDEX IF NOT EXISTS idx_statistics_timestamp ON statistics (timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_statistics_account_timestamp ON statistics (account_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_statistics_chat_timestamp ON statistics (avito_chat_id, timestamp)",
+    ),
+    (
+        """
+        CREATE TABLE IF NOT EXISTS stats_rollup (
+            account_id INTEGER NOT NULL,
+            hour TEXT NOT NULL,
+            direction TEXT NOT NULL,
+            reply_type TEXT NOT NULL DEFAULT '',
+            message_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (account_id, hour, direction, reply_type),
+            FOREIGN KEY (account_id) REFERENCES accounts (id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_stats_rollup_hour ON stats_rollup (hour, direction, message_count)",
+        # Заполняем сводку по уже накопленной истории.
+        """
+        INSERT INTO stats_rollup (account_id, hour, direction, reply_type, message_count)
+        SELECT account_id, substr(timestamp, 1, 13) || ':00:00+00:00', direction, COALESCE(reply_type, ''), COUNT(*)
+        FROM statistics
+        WHERE account_id IN (SELECT id FROM accounts)
+        GROUP BY 1, 2, 3, 4
+        """,
+    ),
+    (
+        """
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            account_id INTEGER NOT NULL,
+            chat_id TEXT NOT NULL,
+            message_id TEXT NOT NULL,
+            created INTEGER NOT NULL DEFAULT 0,
+            direction TEXT,
+            message_text TEXT NOT NULL DEFAULT '',
+            FOREIGN KEY (account_id) REFERENCES accounts (id) ON DELETE CASCADE
+        )
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_account_chat_message ON messages (account_id, chat_id, message_id)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_account_created ON messages (account_id, created)",
+        # unicode61 приводит кириллицу к нижнему регистру; «ё» он не упрощает, поэтому триггеры заменяют ее на «е».
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            message_text, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, message_text) VALUES (new.id, replace(replace(new.message_text, 'ё', 'е'), 'Ё', 'Е'));
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message_text)
+            VALUES ('delete', old.id, replace(replace(old.message_text, 'ё', 'е'), 'Ё', 'Е'));
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message_text)
+            VALUES ('delete', old.id, replace(replace(old.message_text, 'ё', 'е'), 'Ё', 'Е'));
+            INSERT INTO messages_fts (rowid, message_text) VALUES (new.id, replace(replace(new.message_text, 'ё', 'е'), 'Ё', 'Е'));
+        END
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS message_sync (
+            account_id INTEGER NOT NULL,
+            chat_id TEXT NOT NULL,
+            synced_at TEXT NOT NULL,
+            PRIMARY KEY (account_id, chat_id),
+            FOREIGN KEY (account_id) REFERENCES accounts (id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+        """,
+    ),
+    (
+        "ALTER TABLE message_sync ADD COLUMN backfill_offset INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE message_sync ADD COLUMN backfill_complete BOOLEAN NOT NULL DEFAULT 0",
+    ),
+    (
+        """
+        CREATE TABLE IF NOT EXISTS ai_reply_cache (
+            cache_key TEXT PRIMARY KEY,
+            scope_key TEXT NOT NULL,
+            last_message TEXT NOT NULL,
+            reply_text TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            last_used_at INTEGER NOT NULL,
+            hit_count INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_ai_reply_cache_scope ON ai_reply_cache (scope_key, last_used_at)",
+        "CREATE INDEX IF NOT EXISTS idx_ai_reply_cache_last_used ON ai_reply_cache (last_used_at)",
+    ),
+    (
+        # Отдельный учет уведомлений: в messages пишут еще поиск и загрузка истории.
+        """
+        CREATE TABLE IF NOT EXISTS notified_messages (
+            account_id INTEGER NOT NULL,
+            chat_id TEXT NOT NULL,
+            message_id TEXT NOT NULL,
+            created INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (account_id, chat_id, message_id),
+            FOREIGN KEY (account_id) REFERENCES accounts (id) ON DELETE CASCADE
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_notified_messages_created ON notified_messages (created)",
+        # Входящие не новее отметки чата уже обработаны опросом.
+        """
+        INSERT OR IGNORE INTO notified_messages (account_id, chat_id, message_id, created)
+        SELECT m.account_id, m.chat_id, m.message_id, m.created FROM messages m
+        JOIN chat_state c ON c.account_id = m.account_id AND c.chat_id = m.chat_id
+        WHERE m.direction = 'in' AND m.created <= c.last_message_ts
+        """,
+    ),
+    (
+        # Поиск по подстроке, как при загрузке переписки из API: trigram находит «ставк» в «доставка»
+        # и «цен» в «цены». Требуется SQLite 3.34+.
+        "DROP TRIGGER IF EXISTS messages_fts_insert",
+        "DROP TRIGGER IF EXISTS messages_fts_delete",
+        "DROP TRIGGER IF EXISTS messages_fts_update",
+        "DROP TABLE IF EXISTS messages_fts",
+        """
+        CREATE VIRTUAL TABLE messages_fts USING fts5(
+            message_text, content='messages', content_rowid='id', tokenize='trigram'
+        )
+        """,
+        """
+        CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, message_text) VALUES (new.id, replace(replace(new.message_text, 'ё', 'е'), 'Ё', 'Е'));
+        END
+        """,
+        """
+        CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message_text)
+            VALUES ('delete', old.id, replace(replace(old.message_text, 'ё', 'е'), 'Ё', 'Е'));
+        END
+        """,
+        """
+        CREATE TRIGGER messages_fts_update AFTER UPDATE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, message_text)
+            VALUES ('delete', old.id, replace(replace(old.message_text, 'ё', 'е'), 'Ё', 'Е'));
+            INSERT INTO messages_fts (rowid, message_text) VALUES (new.id, replace(replace(new.message_text, 'ё', 'е'), 'Ё', 'Е'));
+        END
+        """,
+        "INSERT INTO messages_fts (rowid, message_text) "
+        "SELECT id, replace(replace(message_text, 'ё', 'е'), 'Ё', 'Е') FROM messages",
+    ),
+    (
+        # История статистики переживает удаление аккаунта, как до включения foreign_keys:
+        # выгрузка показывает такие строки без названия аккаунта. Ссылки на accounts убираем пересозданием таблиц.
+        """
+        CREATE TABLE statistics_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TEXT NOT NULL,
+            account_id INTEGER NOT NULL,
+            avito_chat_id TEXT NOT NULL,
+            direction TEXT NOT NULL,
+            reply_type TEXT,
+            message_text TEXT
+        )
+        """,
+        "INSERT INTO statistics_new (id, timestamp, account_id, avito_chat_id, direction, reply_type, message_text) "
+        "SELECT id, timestamp, account_id, avito_chat_id, direction, reply_type, message_text FROM statistics",
+        "DROP TABLE statistics",
+        "ALTER TABLE statistics_new RENAME TO statistics",
+        "CREATE INDEX IF NOT EXISTS idx_statistics_timestamp ON statistics (timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_statistics_account_timestamp ON statistics (account_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_statistics_chat_timestamp ON statistics (avito_chat_id, timestamp)",
+        """
+        CREATE TABLE stats_rollup_new (
+            account_id INTEGER NOT NULL,
+            hour TEXT NOT NULL,
+            direction TEXT NOT NULL,
+            reply_type TEXT NOT NULL DEFAULT '',
+            message_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (account_id, hour, direction, reply_type)
+        ) WITHOUT ROWID
+        """,
+        "INSERT INTO stats_rollup_new SELECT account_id, hour, direction, reply_type, message_count FROM stats_rollup",
+        "DROP TABLE stats_rollup",
+        "ALTER TABLE stats_rollup_new RENAME TO stats_rollup",
+        "CREATE INDEX IF NOT EXISTS idx_stats_rollup_hour ON stats_rollup (hour, direction, message_count)",
+    ),
+)
+
+
+def _apply_migrations(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        with conn:
+            for statement in statements:
+                conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {number}")
+        logger.info(f"Применена миграция базы данных №{number}.")
+    if version < len(MIGRATIONS):
+        conn.execute("ANALYZE")
 
 
 def add_account(data):
-    with sqlite3.connect(DB_FILE) as conn:
+    with get_connection() as conn:
         cursor = conn.cursor()
         cursor.execute(
             "INSERT INTO accounts (name, client_id, client_secret, profile_id, notification_chat_id) VALUES (?, ?, ?, ?, ?)",
             (data['name'], data['client_id'], data['client_secret'], data['profile_id'], data['chat_id'])
         )
         conn.commit()
+    _bump_settings_version()
 
 
 def get_accounts(active_only=False):
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.row_factory = sqlite3.Row
+    with get_connection() as conn:
         cursor = conn.cursor()
         base_query = """
             SELECT
@@ -102,8 +371,7 @@ def get_accounts(active_only=False):
 
 
 def get_account_by_id(account_id):
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.row_factory = sqlite3.Row
+    with get_connection() as conn:
         cursor = conn.cursor()
         cursor.execute("""
             SELECT
@@ -126,38 +394,41 @@ def get_account_by_id(account_id):
 
 
 def update_account(account_id, field, value):
-    with sqlite3.connect(DB_FILE) as conn:
+    with get_connection() as conn:
         cursor = conn.cursor()
         if value is None:
             cursor.execute(f"UPDATE accounts SET {field} = NULL WHERE id = ?", (account_id,))
         else:
             cursor.execute(f"UPDATE accounts SET {field} = ? WHERE id = ?", (value, account_id))
         conn.commit()
+    _bump_settings_version()
 
 
 def delete_account(account_id):
-    with sqlite3.connect(DB_FILE) as conn:
+    with get_connection() as conn:
         cursor = conn.cursor()
         cursor.execute("DELETE FROM accounts WHERE id = ?", (account_id,))
         conn.commit()
+    _bump_settings_version()
 
 
 def add_canned_response(short_name, text, category_id):
-    with sqlite3.connect(DB_FILE) as conn:
+    with get_connection() as conn:
         cursor = conn.cursor()
         cursor.execute("INSERT INTO canned_responses (short_name, response_text, category_id) VALUES (?, ?, ?)",
                        (short_name, text, category_id))
         conn.commit()
+    _bump_settings_version()
 
 def update_canned_response(response_id, field, value):
-    with sqlite3.connect(DB_FILE) as conn:
+    with get_connection() as conn:
         cursor = conn.cursor()
         cursor.execute(f"UPDATE canned_responses SET {field} = ? WHERE id = ?", (value, response_id))
         conn.commit()
+    _bump_settings_version()
 
 def get_canned_responses():
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.row_factory = sqlite3.Row
+    with get_connection() as conn:
         cursor = conn.cursor()
         cursor.execute("""
             SELECT cr.id, cr.short_name, cr.response_text, rc.name as category_name
@@ -169,16 +440,14 @@ def get_canned_responses():
 
 
 def get_canned_responses_by_category(category_id):
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.row_factory = sqlite3.Row
+    with get_connection() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM canned_responses WHERE category_id = ? ORDER BY short_name", (category_id,))
         return [dict(row) for row in cursor.fetchall()]
 
 
 def get_canned_response_by_id(response_id):
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.row_factory = sqlite3.Row
+    with get_connection() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM canned_responses WHERE id = ?", (response_id,))
         row = cursor.fetchone()
@@ -186,94 +455,579 @@ def get_canned_response_by_id(response_id):
 
 
 def delete_canned_response(response_id):
-    with sqlite3.connect(DB_FILE) as conn:
+    with get_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("PRAGMA foreign_keys = ON;")
         cursor.execute("DELETE FROM canned_responses WHERE id = ?", (response_id,))
         conn.commit()
+    _bump_settings_version()
 
 
 def add_category(name):
-    with sqlite3.connect(DB_FILE) as conn:
+    with get_connection() as conn:
         cursor = conn.cursor()
         cursor.execute("INSERT INTO response_categories (name) VALUES (?)", (name,))
         conn.commit()
+    _bump_settings_version()
 
 
 def get_categories():
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.row_factory = sqlite3.Row
+    with get_connection() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM response_categories ORDER BY name")
         return [dict(row) for row in cursor.fetchall()]
 
 
+def update_category(category_id, name):
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE response_categories SET name = ? WHERE id = ?", (name, category_id))
+        conn.commit()
+    _bump_settings_version()
+
+
 def delete_category(category_id):
-    with sqlite3.connect(DB_FILE) as conn:
+    with get_connection() as conn:
         cursor = conn.cursor()
         cursor.execute("DELETE FROM response_categories WHERE id = ?", (category_id,))
         conn.commit()
+    _bump_settings_version()
+
+
+STATS_INSERT = ("INSERT INTO statistics (account_id, avito_chat_id, direction, reply_type, message_text, timestamp) "
+                "VALUES (?, ?, ?, ?, ?, ?)")
+STATS_ROLLUP_UPSERT = """
+    INSERT INTO stats_rollup (account_id, hour, direction, reply_type, message_count) VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT (account_id, hour, direction, reply_type) DO UPDATE SET
+        message_count = message_count + excluded.message_count
+"""
+
+
+def rollup_hour(timestamp):
+    # timestamp всегда пишется как ISO UTC, поэтому час берем прямо из строки.
+    return f"{timestamp[:13]}:00:00+00:00"
+
+
+def _insert_stats(conn, rows):
+    # Сырые события и сводка обновляются в одной транзакции и не могут разойтись.
+    conn.executemany(STATS_INSERT, rows)
+    rollup = Counter((account_id, rollup_hour(timestamp), direction, reply_type or '')
+                     for account_id, _, direction, reply_type, _, timestamp in rows)
+    conn.executemany(STATS_ROLLUP_UPSERT, [(*key, count) for key, count in rollup.items()])
+
+
+class StatsWriter:
+    def __init__(self, batch_size=200, flush_interval=1.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        self._thread = None
+        self._written = 0
+        self._batches = 0
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._thread = threading.Thread(target=self._run, name='stats-writer', daemon=True)
+        self._thread.start()
+        logger.info(f"Запущена фоновая запись статистики (пачка {self.batch_size}, интервал {self.flush_interval} сек.)")
+
+    def stop(self, timeout=10):
+        if not self.running:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.error("Фоновая запись статистики не завершилась вовремя, часть событий может быть потеряна.")
+        self._thread = None
+        logger.info(f"Фоновая запись статистики остановлена. Записано событий: {self._written}, пачек: {self._batches}.")
+
+    def put(self, row):
+        # Очередь не ограничена: обработчики Telegram никогда не ждут записи в базу.
+        self._queue.put(row)
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = None
+            while len(batch) < self.batch_size:
+                timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+                try:
+                    row = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if row is None:
+                    stopping = True
+                    break
+                batch.append(row)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            if stopping:
+                # Дописываем все, что успело попасть в очередь до остановки.
+                while True:
+                    try:
+                        row = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if row is not None:
+                        batch.append(row)
+            self._write(batch)
+        close_connection()
+
+    def _write(self, batch):
+        if not batch:
+            return
+        try:
+            with get_connection() as conn:
+                _insert_stats(conn, batch)
+            self._written += len(batch)
+            self._batches += 1
+        except sqlite3.Error as e:
+            logger.error(f"Не удалось записать {len(batch)} событий статистики: {e}")
+
+
+stats_writer = StatsWriter()
+
+
+def start_stats_writer(batch_size=None, flush_interval=None):
+    if batch_size is not None:
+        stats_writer.batch_size = max(1, int(batch_size))
+    if flush_interval is not None:
+        stats_writer.flush_interval = max(0.0, float(flush_interval))
+    stats_writer.start()
+    # Страховка на случай выхода без post_shutdown: очередь все равно будет дописана.
+    atexit.register(stop_stats_writer)
+
+
+def stop_stats_writer():
+    stats_writer.stop()
 
 
 def log_message(account_id, avito_chat_id, direction, reply_type, message_text):
-    with sqlite3.connect(DB_FILE) as conn:
-        cursor = conn.cursor()
-        timestamp = datetime.now(timezone.utc).isoformat()
-        cursor.execute(
-            "INSERT INTO statistics (account_id, avito_chat_id, direction, reply_type, message_text, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
-            (account_id, avito_chat_id, direction, reply_type, message_text, timestamp)
-        )
-        conn.commit()
+    timestamp = datetime.now(timezone.utc).isoformat()
+    row = (account_id, avito_chat_id, direction, reply_type, message_text, timestamp)
+    if stats_writer.running:
+        stats_writer.put(row)
+        return
+    # Без фонового писателя (скрипты, миграции) пишем сразу.
+    with get_connection() as conn:
+        _insert_stats(conn, [row])
 
 
-def get_stats_for_period(period: str):
-    if period == 'day':
-        period_filter = "timestamp >= datetime('now', '-1 day', 'localtime')"
-    elif period == 'week':
-        period_filter = "timestamp >= datetime('now', '-7 days', 'localtime')"
-    else:
-        period_filter = "timestamp >= datetime('now', '-30 days', 'localtime')"
+PERIOD_DAYS = {'day': 1, 'week': 7, 'month': 30}
 
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        query = f"""
-            SELECT s.*, a.name as account_name FROM statistics s
-            LEFT JOIN accounts a ON s.account_id = a.id
-            WHERE {period_filter} ORDER BY s.timestamp DESC
-        """
-        cursor.execute(query)
+# Без статистики ANALYZE (например, в новой базе) планировщик проходит сводку целиком по первичному ключу,
+# поэтому индекс по часу указан явно.
+ROLLUP_COUNTS_QUERY = """
+    SELECT account_id, direction, SUM(message_count) AS message_count
+    FROM stats_rollup INDEXED BY idx_stats_rollup_hour
+    WHERE hour >= ? GROUP BY account_id, direction
+"""
+DASHBOARD_QUERY = """
+    SELECT
+        a.id, a.name, a.ai_mode, a.default_category_id,
+        COALESCE(r.received, 0) AS received,
+        COALESCE(r.replied, 0) AS replied,
+        COALESCE(t.template_count, 0) AS template_count
+    FROM accounts a
+    LEFT JOIN (
+        SELECT account_id,
+               SUM(CASE WHEN direction = 'in' THEN message_count ELSE 0 END) AS received,
+               SUM(CASE WHEN direction = 'out' THEN message_count ELSE 0 END) AS replied
+        FROM stats_rollup INDEXED BY idx_stats_rollup_hour WHERE hour >= ? GROUP BY account_id
+    ) r ON r.account_id = a.id
+    LEFT JOIN (
+        SELECT category_id, COUNT(*) AS template_count FROM canned_responses GROUP BY category_id
+    ) t ON t.category_id = a.default_category_id
+    WHERE a.is_active = 1
+    ORDER BY a.id DESC
+"""
+
+
+def period_start(period: str):
+    # Граница считается в Python в том же формате ISO UTC, в котором пишется timestamp,
+    # поэтому сравнение строк корректно и идет диапазоном по индексу. Она округляется вниз до часа,
+    # как и почасовая сводка: счетчики и выгрузка за один период охватывают одни и те же сообщения.
+    days = PERIOD_DAYS.get(period, PERIOD_DAYS['month'])
+    return rollup_hour((datetime.now(timezone.utc) - timedelta(days=days)).isoformat())
+
+
+def get_message_counts_by_account(period: str):
+    # Читаем почасовую сводку: объем работы зависит от длины периода, а не от числа сообщений.
+    with get_connection() as conn:
+        cursor = conn.execute(ROLLUP_COUNTS_QUERY, (period_start(period),))
+        counts = {}
+        for row in cursor:
+            counts.setdefault(row['account_id'], {'in': 0, 'out': 0})[row['direction']] = row['message_count']
+        return counts
+
+
+def build_stats_query(since, until=None, account_id=None, columns="s.*, a.name as account_name"):
+    # Фильтры выгрузки передаются в SQL, чтобы выборка шла диапазоном по индексу.
+    conditions = ["s.timestamp >= ?"]
+    params = [since]
+    if until is not None:
+        conditions.append("s.timestamp < ?")
+        params.append(until)
+    if account_id is not None:
+        conditions.append("s.account_id = ?")
+        params.append(account_id)
+    query = f"""
+        SELECT {columns} FROM statistics s
+        LEFT JOIN accounts a ON s.account_id = a.id
+        WHERE {' AND '.join(conditions)} ORDER BY s.timestamp DESC
+    """
+    return query, params
+
+
+def has_stats(since, until=None, account_id=None):
+    query, params = build_stats_query(since, until, account_id, columns="1")
+    with get_connection() as conn:
+        return conn.execute(f"{query} LIMIT 1", params).fetchone() is not None
+
+
+def has_stats_for_period(period: str):
+    return has_stats(period_start(period))
+
+
+def iter_stats(since, until=None, account_id=None, batch_size=1000):
+    # Отдает строки пачками по мере чтения курсора; использовать в том же потоке, где начат обход.
+    query, params = build_stats_query(since, until, account_id)
+    with get_connection() as conn:
+        cursor = conn.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+
+
+def get_dashboard_rows(period='day'):
+    # Все данные главного меню одним запросом: счетчики из сводки и число шаблонов в категории.
+    with get_connection() as conn:
+        cursor = conn.execute(DASHBOARD_QUERY, (period_start(period),))
         return [dict(row) for row in cursor.fetchall()]
 
+
+def get_message_counts(period: str, account_id=None):
+    totals = {'in': 0, 'out': 0}
+    for acc_id, counts in get_message_counts_by_account(period).items():
+        if account_id is None or acc_id == account_id:
+            for direction, count in counts.items():
+                totals[direction] = totals.get(direction, 0) + count
+    return totals
+
+
+def explain_query_plan(query, params=()):
+    with get_connection() as conn:
+        return [row['detail'] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", params)]
+
+
+def find_full_scans(query, params=(), tables=('statistics', 's', 'stats_rollup')):
+    # В плане SQLite полный проход выглядит как "SCAN s" или "SCAN stats_rollup" без USING INDEX.
+    full_scans = []
+    for detail in explain_query_plan(query, params):
+        words = detail.split()
+        if words[0] == 'SCAN' and len(words) > 1 and words[1] in tables and 'USING' not in words:
+            full_scans.append(detail)
+    return full_scans
+
+
+def check_query_plans():
+    # Проверяются запросы, которые реально выполняются: выгрузка и счетчики из почасовой сводки.
+    since = period_start('day')
+    full_scans = find_full_scans(*build_stats_query(since))
+    full_scans += find_full_scans(*build_stats_query(since, since, 1))
+    full_scans += find_full_scans(ROLLUP_COUNTS_QUERY, (since,))
+    full_scans += find_full_scans(DASHBOARD_QUERY, (since,))
+    for detail in full_scans:
+        logger.warning(f"Запрос статистики за период выполняется полным проходом таблицы: {detail}")
+    return not full_scans
+
+
 def get_prompts():
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.row_factory = sqlite3.Row
+    with get_connection() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT * FROM prompts ORDER BY name")
         return [dict(row) for row in cursor.fetchall()]
 
 def add_prompt(name, text):
-    with sqlite3.connect(DB_FILE) as conn:
+    with get_connection() as conn:
         cursor = conn.cursor()
         cursor.execute("INSERT INTO prompts (name, prompt_text) VALUES (?, ?)", (name, text))
         conn.commit()
 
 def update_prompt(prompt_id, field, value):
-    with sqlite3.connect(DB_FILE) as conn:
+    with get_connection() as conn:
         cursor = conn.cursor()
         cursor.execute(f"UPDATE prompts SET {field} = ? WHERE id = ?", (value, prompt_id))
         conn.commit()
 
 def delete_prompt(prompt_id):
-    with sqlite3.connect(DB_FILE) as conn:
+    with get_connection() as conn:
         cursor = conn.cursor()
         cursor.execute("DELETE FROM prompts WHERE id = ?", (prompt_id,))
         conn.commit()
 
 def get_account_by_profile_id(profile_id):
- with sqlite3.connect(DB_FILE) as conn:
-     conn.row_factory = sqlite3.Row
-     cursor = conn.cursor()
-     cursor.execute("SELECT * FROM accounts WHERE profile_id = ?", (profile_id,))
-     row = cursor.fetchone()
-     return dict(row) if row else None
\ No newline at end of file
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM accounts WHERE profile_id = ?", (profile_id,))
+        row = cursor.fetchone()
+        return dict(row) if row else None
+
+
+CHAT_STATE_UPSERT = """
+    INSERT INTO chat_state (account_id, chat_id, last_message_ts, last_direction, is_unread, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (account_id, chat_id) DO UPDATE SET
+        last_direction = CASE WHEN excluded.last_message_ts >= chat_state.last_message_ts
+                              THEN excluded.last_direction ELSE chat_state.last_direction END,
+        is_unread = CASE WHEN excluded.last_message_ts >= chat_state.last_message_ts
+                         THEN excluded.is_unread ELSE chat_state.is_unread END,
+        last_message_ts = MAX(chat_state.last_message_ts, excluded.last_message_ts),
+        updated_at = excluded.updated_at
+"""
+
+
+def has_chat_state(account_id):
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1 FROM chat_state WHERE account_id = ? LIMIT 1", (account_id,))
+        return cursor.fetchone() is not None
+
+
+def get_chat_watermarks(account_id, chat_ids):
+    chat_ids = list(chat_ids)
+    watermarks = {}
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        # Разбиваем на пачки, чтобы не превысить лимит параметров SQLite.
+        for i in range(0, len(chat_ids), 500):
+            batch = chat_ids[i:i + 500]
+            placeholders = ','.join('?' * len(batch))
+            cursor.execute(
+                f"SELECT chat_id, last_message_ts FROM chat_state WHERE account_id = ? AND chat_id IN ({placeholders})",
+                (account_id, *batch)
+            )
+            watermarks.update((row['chat_id'], row['last_message_ts']) for row in cursor.fetchall())
+    return watermarks
+
+
+def upsert_chat_states(account_id, states):
+    updated_at = datetime.now(timezone.utc).isoformat()
+    rows = [(account_id, chat_id, ts, direction, bool(is_unread), updated_at)
+            for chat_id, ts, direction, is_unread in states]
+    if not rows:
+        return
+    with get_connection() as conn:
+        conn.executemany(CHAT_STATE_UPSERT, rows)
+        conn.commit()
+
+
+def upsert_chat_state(account_id, chat_id, last_message_ts, last_direction, is_unread):
+    upsert_chat_states(account_id, [(chat_id, last_message_ts, last_direction, is_unread)])
+
+
+def import_last_timestamps_json(file_path):
+    if not os.path.exists(file_path):
+        return
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            last_timestamps = json.load(f)
+    except (json.JSONDecodeError, OSError) as e:
+        logger.error(f"Не удалось прочитать {file_path} для миграции: {e}")
+        return
+
+    with get_connection() as conn:
+        existing_accounts = {row[0] for row in conn.execute("SELECT id FROM accounts")}
+    imported = 0
+    for account_id_str, chats in last_timestamps.items():
+        if not account_id_str.isdigit() or int(account_id_str) not in existing_accounts:
+            continue
+        # Направление в старом файле не хранилось: отметка всегда ставилась по входящему сообщению.
+        upsert_chat_states(int(account_id_str), [(chat_id, int(ts), 'in', False) for chat_id, ts in chats.items()])
+        imported += len(chats)
+
+    os.replace(file_path, f"{file_path}.migrated")
+    logger.info(f"Перенесено {imported} отметок чатов из {file_path} в базу данных.")
+
+
+MESSAGE_INSERT = """
+    INSERT OR IGNORE INTO messages (account_id, chat_id, message_id, created, direction, message_text)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+MESSAGE_SYNC_UPSERT = """
+    INSERT INTO message_sync (account_id, chat_id, synced_at) VALUES (?, ?, ?)
+    ON CONFLICT (account_id, chat_id) DO UPDATE SET synced_at = excluded.synced_at
+"""
+
+
+def message_key(msg):
+    # У сообщения без id ключом служат время и направление, чтобы повторная загрузка не дублировала его.
+    return str(msg.get('id') or f"{msg.get('created', 0)}:{msg.get('direction')}")
+
+
+def _message_row(account_id, chat_id, msg):
+    text = (msg.get('content') or {}).get('text')
+    if msg.get('type', 'text') != 'text' or not text:
+        return None
+    return account_id, chat_id, message_key(msg), msg.get('created', 0), msg.get('direction'), text
+
+
+def store_messages(account_id, chat_id, messages, mark_synced=False):
+    # Только индекс для поиска: об уведомлениях знает notified_messages, поэтому писать сюда может любой путь.
+    rows = [row for row in (_message_row(account_id, chat_id, msg) for msg in messages or []) if row]
+    with get_connection() as conn:
+        conn.executemany(MESSAGE_INSERT, rows)
+        if mark_synced:
+            conn.execute(MESSAGE_SYNC_UPSERT, (account_id, chat_id, datetime.now(timezone.utc).isoformat()))
+
+
+def claim_notifications(account_id, chat_id, messages):
+    # Отмечает сообщения как обработанные и возвращает ключи тех, о которых еще не уведомляли:
+    # опрос и вебхук не дублируют друг друга.
+    claimed = set()
+    with get_connection() as conn:
+        for msg in messages:
+            key = message_key(msg)
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO notified_messages (account_id, chat_id, message_id, created) VALUES (?, ?, ?, ?)",
+                (account_id, chat_id, key, msg.get('created', 0))
+            )
+            if cursor.rowcount:
+                claimed.add(key)
+    return claimed
+
+
+def prune_notified_messages(before_ts):
+    with get_connection() as conn:
+        return conn.execute("DELETE FROM notified_messages WHERE created < ?", (before_ts,)).rowcount
+
+
+def get_synced_chat_ids(account_id, chat_ids):
+    chat_ids = list(chat_ids)
+    synced = set()
+    with get_connection() as conn:
+        for i in range(0, len(chat_ids), 500):
+            batch = chat_ids[i:i + 500]
+            placeholders = ','.join('?' * len(batch))
+            cursor = conn.execute(
+                f"SELECT chat_id FROM message_sync WHERE account_id = ? AND chat_id IN ({placeholders})",
+                (account_id, *batch)
+            )
+            synced.update(row['chat_id'] for row in cursor)
+    return synced
+
+
+def normalize_search_text(text):
+    # Одна нормализация для индекса, API и метаданных чата: регистр и «ё» не влияют на результат.
+    return (text or '').lower().replace('ё', 'е')
+
+
+def search_message_chats(account_id, text, limit=500):
+    # Ищется подстрока целиком, как в переписке, загруженной из API.
+    text = normalize_search_text(text).strip()
+    if not text:
+        return []
+    with get_connection() as conn:
+        if len(text) >= 3:
+            # CROSS JOIN фиксирует порядок: сначала поиск по индексу FTS, затем выборка строк по rowid.
+            cursor = conn.execute("""
+                SELECT m.chat_id, MAX(m.created) AS last_match FROM messages_fts f
+                CROSS JOIN messages m ON m.id = f.rowid
+                WHERE messages_fts MATCH ? AND m.account_id = ?
+                GROUP BY m.chat_id ORDER BY last_match DESC LIMIT ?
+            """, ('"' + text.replace('"', '""') + '"', account_id, limit))
+        else:
+            # Trigram не ищет строки короче трех символов, их проверяем проходом по сообщениям аккаунта.
+            cursor = conn.execute("""
+                SELECT chat_id, MAX(created) AS last_match FROM messages
+                WHERE account_id = ? AND instr(search_fold(message_text), ?) > 0
+                GROUP BY chat_id ORDER BY last_match DESC LIMIT ?
+            """, (account_id, text, limit))
+        return [row['chat_id'] for row in cursor]
+
+
+def get_backfill_checkpoints(account_id, chat_ids):
+    chat_ids = list(chat_ids)
+    checkpoints = {}
+    with get_connection() as conn:
+        for i in range(0, len(chat_ids), 500):
+            batch = chat_ids[i:i + 500]
+            placeholders = ','.join('?' * len(batch))
+            cursor = conn.execute(
+                f"SELECT chat_id, backfill_offset, backfill_complete FROM message_sync "
+                f"WHERE account_id = ? AND chat_id IN ({placeholders})",
+                (account_id, *batch)
+            )
+            checkpoints.update((row['chat_id'], (row['backfill_offset'], bool(row['backfill_complete'])))
+                               for row in cursor)
+    return checkpoints
+
+
+def store_backfill_page(account_id, chat_id, messages, next_offset, complete):
+    # Страница и отметка пишутся одной транзакцией: после перезапуска загрузка продолжится с того же места.
+    rows = [row for row in (_message_row(account_id, chat_id, msg) for msg in messages or []) if row]
+    with get_connection() as conn:
+        conn.executemany(MESSAGE_INSERT, rows)
+        conn.execute("""
+            INSERT INTO message_sync (account_id, chat_id, synced_at, backfill_offset, backfill_complete)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (account_id, chat_id) DO UPDATE SET
+                synced_at = excluded.synced_at,
+                backfill_offset = excluded.backfill_offset,
+                backfill_complete = excluded.backfill_complete
+        """, (account_id, chat_id, datetime.now(timezone.utc).isoformat(), next_offset, bool(complete)))
+
+
+def get_ai_cache_entry(cache_key, min_created_at):
+    with get_connection() as conn:
+        row = conn.execute("SELECT * FROM ai_reply_cache WHERE cache_key = ? AND created_at >= ?",
+                           (cache_key, min_created_at)).fetchone()
+        return dict(row) if row else None
+
+
+def get_ai_cache_candidates(scope_key, min_created_at, limit=200):
+    with get_connection() as conn:
+        cursor = conn.execute("""
+            SELECT cache_key, last_message, reply_text FROM ai_reply_cache
+            WHERE scope_key = ? AND created_at >= ? ORDER BY last_used_at DESC LIMIT ?
+        """, (scope_key, min_created_at, limit))
+        return [dict(row) for row in cursor.fetchall()]
+
+
+def touch_ai_cache_entry(cache_key):
+    with get_connection() as conn:
+        conn.execute("UPDATE ai_reply_cache SET last_used_at = ?, hit_count = hit_count + 1 WHERE cache_key = ?",
+                     (int(time.time()), cache_key))
+
+
+def put_ai_cache_entry(cache_key, scope_key, last_message, reply_text):
+    now = int(time.time())
+    with get_connection() as conn:
+        conn.execute("""
+            INSERT INTO ai_reply_cache (cache_key, scope_key, last_message, reply_text, created_at, last_used_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (cache_key) DO UPDATE SET
+                reply_text = excluded.reply_text, created_at = excluded.created_at, last_used_at = excluded.last_used_at
+        """, (cache_key, scope_key, last_message, reply_text, now, now))
+
+
+def prune_ai_cache(max_entries, min_created_at):
+    # Сначала удаляем устаревшие по TTL записи, затем самые давно использованные сверх лимита.
+    with get_connection() as conn:
+        expired = conn.execute("DELETE FROM ai_reply_cache WHERE created_at < ?", (min_created_at,)).rowcount
+        evicted = conn.execute("""
+            DELETE FROM ai_reply_cache WHERE cache_key IN (
+                SELECT cache_key FROM ai_reply_cache ORDER BY last_used_at DESC LIMIT -1 OFFSET ?
+            )
+        """, (max_entries,)).rowcount
+        return expired + evicted
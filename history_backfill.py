@@ -0,0 +1,70 @@
+import logging
+
+import avito_client
+import chat_sync
+import database as db
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = 100
+# Avito не отдает сообщения дальше этого смещения.
+MAX_OFFSET = 1000
+
+
+class HistoryBackfill:
+    def __init__(self, request_budget=50, pause_threshold=2):
+        self.request_budget = request_budget
+        self.pause_threshold = pause_threshold
+        self._requests_used = 0
+
+    def _can_continue(self):
+        if self._requests_used >= self.request_budget:
+            return False
+        # Фоновая загрузка уступает ручным ответам и автоответам; опрос ее не останавливает.
+        return avito_client.scheduler.load_above(avito_client.PRIORITY_POLLING) < self.pause_threshold
+
+    @avito_client.with_priority(avito_client.PRIORITY_BACKGROUND)
+    async def run(self, accounts, archive_boundary_ts):
+        self._requests_used = 0
+        chats_completed = 0
+        for account in accounts:
+            if not self._can_continue():
+                break
+            chats_completed += await self._backfill_account(account, archive_boundary_ts)
+
+        if self._requests_used:
+            logger.info(f"Загрузка истории: запросов {self._requests_used} из {self.request_budget}, "
+                        f"чатов загружено полностью: {chats_completed}.")
+        return self._requests_used
+
+    async def _backfill_account(self, account, archive_boundary_ts):
+        token = await avito_client.get_token(account['client_id'], account['client_secret'])
+        if not token:
+            return 0
+
+        chats = await chat_sync.synchronizer.sync(token, account, archive_boundary_ts) or []
+        checkpoints = db.get_backfill_checkpoints(account['id'], [chat['id'] for chat in chats])
+        pending_chats = [chat for chat in chats if not checkpoints.get(chat['id'], (0, False))[1]]
+
+        chats_completed = 0
+        for chat in pending_chats:
+            offset = checkpoints.get(chat['id'], (0, False))[0]
+            while self._can_continue():
+                self._requests_used += 1
+                messages = await avito_client.get_messages(token, account['profile_id'], chat['id'],
+                                                           limit=PAGE_SIZE, offset=offset)
+                if messages is None:
+                    # Отметка не сдвигается, чат будет повторен при следующем запуске.
+                    break
+                offset += len(messages)
+                complete = len(messages) < PAGE_SIZE or offset >= MAX_OFFSET
+                db.store_backfill_page(account['id'], chat['id'], messages, offset, complete)
+                if complete:
+                    chats_completed += 1
+                    break
+            if not self._can_continue():
+                break
+        return chats_completed
+
+
+backfill = HistoryBackfill()
@@ -0,0 +1,180 @@
+import argparse
+import csv
+import gzip
+import io
+import logging
+import shutil
+import tempfile
+from datetime import datetime, timezone
+from itertools import chain, islice
+from zoneinfo import ZoneInfo
+
+from openpyxl import Workbook
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.utils import get_column_letter
+
+import database as db
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+logger = logging.getLogger(__name__)
+
+EXPORT_TIMEZONE = ZoneInfo('Europe/Moscow')
+EXPORT_COLUMNS = (
+    ('timestamp', 'Дата (МСК)'),
+    ('account_name', 'Аккаунт Avito'),
+    ('direction', 'Направление'),
+    ('reply_type', 'Тип ответа'),
+    ('message_text', 'Текст сообщения'),
+)
+# Для аналитических форматов время остается в ISO UTC, добавлены идентификаторы.
+RAW_COLUMNS = ('timestamp', 'account_id', 'account_name', 'avito_chat_id', 'direction', 'reply_type', 'message_text')
+WIDTH_SAMPLE_ROWS = 500
+MAX_COLUMN_WIDTH = 80
+PARQUET_BATCH_ROWS = 10000
+# Файлы до этого размера держим в памяти, более крупные сбрасываются во временный файл на диске.
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+EXPORT_FORMATS = {
+    'xlsx': 'xlsx',
+    'csv': 'csv',
+    'csvgz': 'csv.gz',
+    'parquet': 'parquet',
+}
+
+
+def available_formats():
+    return [fmt for fmt in EXPORT_FORMATS if fmt != 'parquet' or pq is not None]
+
+
+def format_timestamp(value):
+    return datetime.fromisoformat(value).astimezone(EXPORT_TIMEZONE).strftime('%d.%m.%Y %H:%M:%S')
+
+
+def format_value(key, value):
+    if key == 'timestamp':
+        return format_timestamp(value)
+    if isinstance(value, str):
+        # Управляющие символы из текста сообщений openpyxl в ячейку не пропускает.
+        return ILLEGAL_CHARACTERS_RE.sub('', value)
+    return value
+
+
+def estimate_column_widths(sample_rows):
+    # Ширину оцениваем по первым строкам, а не по всей выгрузке.
+    widths = [len(title) for _, title in EXPORT_COLUMNS]
+    for row in sample_rows:
+        for i, value in enumerate(row):
+            if value is not None:
+                widths[i] = max(widths[i], len(str(value)))
+    return [min(width + 3, MAX_COLUMN_WIDTH) for width in widths]
+
+
+def write_xlsx(stats_rows, output):
+    rows = ([format_value(key, row[key]) for key, _ in EXPORT_COLUMNS] for row in stats_rows)
+    sample = list(islice(rows, WIDTH_SAMPLE_ROWS))
+
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet('Статистика')
+    for i, width in enumerate(estimate_column_widths(sample)):
+        worksheet.column_dimensions[get_column_letter(i + 1)].width = width
+    worksheet.append([title for _, title in EXPORT_COLUMNS])
+
+    row_count = 0
+    for row in chain(sample, rows):
+        worksheet.append(row)
+        row_count += 1
+    workbook.save(output)
+    return row_count
+
+
+def write_csv(stats_rows, output, compress=False):
+    binary = gzip.GzipFile(fileobj=output, mode='wb', compresslevel=6) if compress else output
+    # utf-8-sig, чтобы Excel сразу распознал кириллицу.
+    text = io.TextIOWrapper(binary, encoding='utf-8-sig', newline='')
+    writer = csv.writer(text)
+    writer.writerow(RAW_COLUMNS)
+    row_count = 0
+    for row in stats_rows:
+        writer.writerow([row[key] for key in RAW_COLUMNS])
+        row_count += 1
+    text.flush()
+    text.detach()
+    if compress:
+        binary.close()
+    return row_count
+
+
+def write_parquet(stats_rows, output):
+    if pq is None:
+        raise RuntimeError("Для выгрузки в Parquet установите пакет pyarrow.")
+    schema = pa.schema([
+        ('timestamp', pa.timestamp('us', tz='UTC')),
+        ('account_id', pa.int64()),
+        ('account_name', pa.string()),
+        ('avito_chat_id', pa.string()),
+        ('direction', pa.string()),
+        ('reply_type', pa.string()),
+        ('message_text', pa.string()),
+    ])
+    row_count = 0
+    with pq.ParquetWriter(output, schema, compression='zstd') as writer:
+        while True:
+            batch = list(islice(stats_rows, PARQUET_BATCH_ROWS))
+            if not batch:
+                break
+            columns = {key: [row[key] for row in batch] for key in RAW_COLUMNS}
+            columns['timestamp'] = [datetime.fromisoformat(value) for value in columns['timestamp']]
+            writer.write_batch(pa.RecordBatch.from_pydict(columns, schema=schema))
+            row_count += len(batch)
+    return row_count
+
+
+def export_stats(fmt, since, until=None, account_id=None):
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Неизвестный формат выгрузки: {fmt}")
+    stats_rows = db.iter_stats(since, until, account_id)
+    output = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    try:
+        if fmt == 'xlsx':
+            row_count = write_xlsx(stats_rows, output)
+        elif fmt == 'parquet':
+            row_count = write_parquet(stats_rows, output)
+        else:
+            row_count = write_csv(stats_rows, output, compress=fmt == 'csvgz')
+    except Exception:
+        output.close()
+        raise
+    size = output.tell()
+    output.seek(0)
+    logger.info(f"Выгрузка статистики в {EXPORT_FORMATS[fmt]}: строк {row_count}, размер {size / 1024:.0f} КБ.")
+    return output, size
+
+
+def export_stats_for_period(fmt, period, account_id=None):
+    return export_stats(fmt, db.period_start(period), account_id=account_id)
+
+
+def parse_date(value):
+    return datetime.fromisoformat(value).replace(tzinfo=timezone.utc).isoformat()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Выгрузка статистики сообщений Avito в файл.")
+    parser.add_argument('--format', choices=list(EXPORT_FORMATS), default='csvgz')
+    parser.add_argument('--since', required=True, help="Начало периода (UTC), например 2024-01-01")
+    parser.add_argument('--until', help="Конец периода (UTC, не включительно)")
+    parser.add_argument('--account-id', type=int)
+    parser.add_argument('--output', required=True)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    result, _ = export_stats(args.format, parse_date(args.since), args.until and parse_date(args.until),
+                             args.account_id)
+    with result, open(args.output, 'wb') as f:
+        shutil.copyfileobj(result, f)